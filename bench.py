@@ -0,0 +1,178 @@
+import io
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+from exporter import create_tree, extract_paths, level_flattening, sheet_names, RowSpool, XlsxExport, XLSX_RESERVED_SHEETS
+try:
+    import resource
+except ImportError: # Windows, peak RSS is then not reported
+    resource = None
+
+# Benchmarks for the export path on a generated curriculum: python3 bench.py paths --depth 8 --fan 4
+# python3 bench.py xlsx --depth 7 --fan 4 runs every xlsx writer in a fresh process for its peak RSS
+
+def synthetic_items(depth, fan, objectives=2, seed=1):
+    # one year (Y) of topic (T) levels, every topic also holding a few learning objectives (O)
+    rnd = random.Random(seed)
+    items = {}
+
+    def add(node_type, level):
+        node_id = str(len(items) + 1)
+        items[node_id] = {"type": node_type, "title": f"{node_type}{node_id} {rnd.randint(0, 999)}", "subtitle": "", "uuid": f"uuid-{node_id}", "children": None}
+        if node_type != "O" and level < depth:
+            children = [add("T", level + 1) for _ in range(fan)]
+            children += [add("O", level + 1) for _ in range(objectives)]
+            items[node_id]["children"] = children
+        return node_id
+
+    root = add("Y", 0)
+    return items, root
+
+def climbing_paths(node, lo):
+    # extract_paths before the single pass: every leaf walks back up to the year node
+    paths = {}
+    tree = node.tree
+    for index in tree.preorder(node.index):
+        if not tree.is_leaf(index):
+            continue
+        path = []
+        lo_path = []
+        current = tree.node(index)
+        while current:
+            obj_type = current.obj["type"]
+            if obj_type == "Y":
+                break
+            elif obj_type == "O":
+                if lo:
+                    lo_path.append(current)
+                current = current.parent
+                continue
+            path.append(current)
+            current = current.parent
+        if str(path[::-1]) not in paths:
+            paths[str(path[::-1])] = {"path": path[::-1], "lo_path": lo_path[::-1]}
+        elif len(lo_path) > 0:
+            paths[str(path[::-1])]["lo_path"].extend(lo_path[::-1])
+    return paths
+
+def best_of(repeat, fn, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def names(paths):
+    return [([n.name for n in v["path"]], [n.name for n in v["lo_path"]]) for v in paths.values()]
+
+def pandas_xlsx(file_path, rows):
+    # the xlsx branch of sofia_exporter before streaming: a DataFrame per table through pd.ExcelWriter
+    import pandas as pd
+    data_dict = {}
+    for sheet, table, row, _ in rows:
+        if table is None:
+            data_dict.setdefault(sheet, []).append(row)
+        else:
+            data_dict.setdefault(sheet, {}).setdefault(table, []).append(row)
+    names = sheet_names([sheet for sheet in data_dict if sheet not in ("level1", "Learning Objectives")], XLSX_RESERVED_SHEETS)
+    with pd.ExcelWriter(file_path + ".xlsx") as writer:
+        for top_level, sheet_data in data_dict.items():
+            if top_level == "level1":
+                pd.DataFrame(sheet_data).to_excel(writer, sheet_name="Level 1 Only", index=False)
+                continue
+            elif top_level == "Learning Objectives":
+                pd.DataFrame(sheet_data).to_excel(writer, sheet_name="Learning Objectives", index=True)
+                continue
+            last_row = 0
+            for table_data in sheet_data.values():
+                df = pd.DataFrame(table_data)
+                df.to_excel(writer, sheet_name=names[top_level], startrow=last_row, index=False)
+                last_row += df.shape[0] + 2
+
+def streaming_xlsx(file_path, rows, constant_memory):
+    spool = RowSpool(file_path + ".spool")
+    export = XlsxExport(file_path, spool, 0, constant_memory)
+    for sheet, table, row, _ in rows:
+        spool.add(sheet, table, row)
+    spool.finish()
+    for job in export.finish():
+        job()
+
+XLSX_WRITERS = {
+    "pandas": pandas_xlsx,
+    "xlsxwriter": lambda file_path, rows: streaming_xlsx(file_path, rows, False),
+    "constant-memory": lambda file_path, rows: streaming_xlsx(file_path, rows, True),
+}
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def run_xlsx(writer, args, directory, results):
+    # runs in its own process, so the peak RSS belongs to this writer alone
+    items, root_id = synthetic_items(args.depth, args.fan, args.objectives)
+    paths, _ = extract_paths(create_tree(items, root_id), True)
+    if writer == "pandas":
+        import pandas # loaded up front so its import is not counted against the writer
+    before = peak_rss()
+    start = time.perf_counter()
+    file_path = os.path.join(directory, writer)
+    with contextlib.redirect_stdout(io.StringIO()):
+        XLSX_WRITERS[writer](file_path, level_flattening(paths, "Intermediate-level"))
+    elapsed = time.perf_counter() - start
+    results.put((writer, elapsed, before, peak_rss(), os.path.getsize(file_path + ".xlsx")))
+
+def bench_xlsx(args):
+    items, _ = synthetic_items(args.depth, args.fan, args.objectives)
+    print(f"{len(items)} nodes, depth {args.depth}, fan-out {args.fan}")
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    with tempfile.TemporaryDirectory() as directory:
+        for writer in args.writers:
+            process = context.Process(target=run_xlsx, args=(writer, args, directory, results))
+            process.start()
+            name, elapsed, before, after, size = results.get()
+            process.join()
+            rss = f"peak RSS {after / 1024:.0f} MiB (+{(after - before) / 1024:.0f} MiB exporting)" if after is not None else "peak RSS n/a"
+            print(f"{name:16} {elapsed:.2f}s  {rss}  {size / 1024 / 1024:.1f} MiB file")
+
+def bench_paths(args):
+    items, root_id = synthetic_items(args.depth, args.fan, args.objectives)
+    root = create_tree(items, root_id)
+    print(f"{len(items)} nodes, depth {args.depth}, fan-out {args.fan}")
+    old_time, old = best_of(args.repeat, climbing_paths, root, True)
+    new_time, (new, _) = best_of(args.repeat, extract_paths, root, True)
+    if names(old) != names(new):
+        raise SystemExit("extract_paths output differs from the climbing version")
+    print(f"climbing:    {old_time:.3f}s")
+    print(f"single pass: {new_time:.3f}s ({old_time / new_time:.1f}x)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the exporter on a generated curriculum")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    paths_parser = subparsers.add_parser("paths", help="extract_paths against the per-leaf climbing version")
+    paths_parser.add_argument("--depth", type=int, default=7)
+    paths_parser.add_argument("--fan", type=int, default=4)
+    paths_parser.add_argument("--objectives", type=int, default=2)
+    paths_parser.add_argument("--repeat", type=int, default=3)
+    xlsx_parser = subparsers.add_parser("xlsx", help="peak RSS and wall time of the xlsx writers")
+    xlsx_parser.add_argument("--depth", type=int, default=7)
+    xlsx_parser.add_argument("--fan", type=int, default=4)
+    xlsx_parser.add_argument("--objectives", type=int, default=2)
+    xlsx_parser.add_argument("--writers", nargs="+", choices=list(XLSX_WRITERS), default=list(XLSX_WRITERS))
+    args = parser.parse_args()
+    match args.command:
+        case "paths":
+            bench_paths(args)
+        case "xlsx":
+            bench_xlsx(args)
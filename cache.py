@@ -0,0 +1,73 @@
+import sys
+import threading
+from collections import OrderedDict
+
+SIZE_SAMPLES = 64
+
+def deep_size(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k) + deep_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(v) for v in obj)
+    return size
+
+def sampled_size(mapping, samples=SIZE_SAMPLES):
+    # deep size of a few evenly spaced values scaled up to the whole mapping,
+    # measuring every parsed item of a big curriculum takes longer than building its tree
+    values = list(mapping.values())
+    if not values:
+        return sys.getsizeof(mapping)
+    sample = values[::max(1, len(values) // samples)]
+    return sys.getsizeof(mapping) + sum(map(deep_size, sample)) * len(values) // len(sample)
+
+class LRUCache:
+    # Keys are (snapshot, key) pairs. Each entry remembers the manifest checksum of its snapshot,
+    # and a lookup with a different checksum drops everything cached for that snapshot.
+    # The least recently used entries are evicted once the estimated size goes over budget (bytes).
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict() # key -> (value, size, checksum)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, checksum):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] != checksum:
+                self.drop_snapshot(key[0])
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size, checksum):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size > self.budget: # would push out everything else and still not fit
+                return value
+            self.entries[key] = (value, size, checksum)
+            self.size += size
+            while self.size > self.budget:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+        return value
+
+    def drop_snapshot(self, snapshot):
+        for key in [key for key in self.entries if key[0] == snapshot]:
+            self.size -= self.entries.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "size": self.size, "budget": self.budget, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions, "invalidations": self.invalidations}
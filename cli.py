@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import argparse
+import exporter
+import scraper
+
+# Headless batch mode, nothing here imports tkinter or PIL:
+#   python3 cli.py --scrape --years Y1 Y2 --formats csv xlsx --out exports
+# Credentials come from SOFIA_USERNAME/SOFIA_PASSWORD, or from a file of KEY=value lines (--credentials).
+# Without --scrape the latest stored snapshot (or --snapshot) is exported.
+
+CREDENTIAL_KEYS = ["SOFIA_USERNAME", "SOFIA_PASSWORD"]
+
+def read_credentials(file_path=None):
+    values = {key: os.environ.get(key) for key in CREDENTIAL_KEYS}
+    if file_path:
+        with open(file_path, encoding="utf-8") as f:
+            for line in f:
+                key, separator, value = line.strip().partition("=")
+                if separator and key.strip() in values:
+                    values[key.strip()] = value.strip().strip("\"'")
+    return values["SOFIA_USERNAME"], values["SOFIA_PASSWORD"]
+
+def print_number(number):
+    print(f"2FA number: {number}", flush=True)
+
+def scrape(username, password, report_number=print_number):
+    # the sign-in and capture steps of the ui's LoginWindow, on a session of our own.
+    # report_number(number) gets the 2FA number to approve, returns False when signing in failed
+    session = scraper.ScraperSession()
+    try:
+        shortcode = (username or scraper.last_profile()) if scraper.PERSIST_SESSION else None
+        web = session.submit(session.ensure_started, shortcode).result()
+        if not web["status"]:
+            if not (username and password):
+                print(f"No credentials: set {' and '.join(CREDENTIAL_KEYS)} or pass --credentials")
+                return False
+            if not session.submit(scraper.verify_credentials, web["driver"], report_number, username, password).result():
+                print("Verification failed")
+                return False
+        fetch = scraper.replay_traffic if scraper.REPLAY_MODE else scraper.monitor_traffic
+        session.submit(session.capture, fetch).result()
+        if shortcode:
+            session.submit(scraper.save_session, web["driver"], shortcode).result()
+        return True
+    finally:
+        session.close()
+
+def year_indexes(steps, years):
+    # years: step codes ("Y1") or positions in the user's steps, none means every year
+    if not years:
+        return list(range(len(steps)))
+    codes = [step["code"] for step in steps]
+    indexes = []
+    for year in years:
+        if year in codes:
+            indexes.append(codes.index(year))
+        elif year.isdigit() and int(year) < len(steps):
+            indexes.append(int(year))
+        else:
+            raise SystemExit(f"Unknown year {year!r}, choose from {', '.join(codes)}")
+    return indexes
+
+def export(snapshot, years, file_types, out, sortby, lo, flatten):
+    steps, statements = exporter.get_curriculum(exporter.get_files([snapshot])[snapshot])
+    for index in year_indexes(steps, years):
+        print(f"Exporting {statements[index]} of {snapshot}")
+        node = exporter.get_tree([snapshot], index)
+        if node is None:
+            continue
+        paths, spreadsheet_name = exporter.extract_paths(node, lo)
+        spreadsheet_name = exporter.FILE_NAME_CHARS.sub("_", spreadsheet_name) + f"_{int(time.time())}"
+        exporter.sofia_exporter(os.path.join(out, spreadsheet_name), exporter.level_flattening(paths, flatten), sortby, file_types)
+    stats = exporter.snapshot_cache.stats()
+    print(f"Cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions, {stats['invalidations']} invalidations, "
+          f"{stats['entries']} entries using {stats['size'] / 2**20:.1f} of {stats['budget'] / 2**20:.0f} MiB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape Sofia and export curriculum years without the ui")
+    parser.add_argument("--scrape", action="store_true", help="capture a new snapshot before exporting")
+    parser.add_argument("--credentials", help="file with SOFIA_USERNAME=... and SOFIA_PASSWORD=... lines")
+    parser.add_argument("--snapshot", help="snapshot to export, the latest by default")
+    parser.add_argument("--years", nargs="*", default=[], help="step codes or indexes, every year by default")
+    parser.add_argument("--formats", nargs="+", choices=exporter.FILE_TYPES, default=["xlsx"])
+    parser.add_argument("--out", default=".", help="folder the exports are written to")
+    parser.add_argument("--sortby", choices=exporter.SORTBY_OPTIONS, default="Alphabetical (A-Z)")
+    parser.add_argument("--flatten", choices=exporter.FLATTEN_OPTIONS, default="Intermediate-level")
+    parser.add_argument("--no-lo", dest="lo", action="store_false", help="leave learning objectives out")
+    parser.add_argument("--list", action="store_true", help="list the stored snapshots and their years, then exit")
+    parser.add_argument("--dump-snapshot", metavar="DIR", help="copy the payloads of the snapshot to DIR as json files, then exit")
+    parser.add_argument("--pretty", action="store_true", help="indent the json written by --dump-snapshot")
+    args = parser.parse_args()
+    if args.scrape and not scrape(*read_credentials(args.credentials)):
+        sys.exit(1)
+    responses = exporter.get_responses()
+    if args.list:
+        paths = exporter.get_files(responses)
+        for response in responses:
+            _, statements = exporter.get_curriculum(paths[response])
+            print(f"{response}  {exporter.epoch_to_datetime(float(response))}  {', '.join(statements)}")
+        sys.exit(0)
+    if not responses:
+        sys.exit("No snapshots stored, run with --scrape first")
+    snapshot = args.snapshot or responses[0]
+    if snapshot not in responses:
+        sys.exit(f"Unknown snapshot {snapshot}")
+    if args.dump_snapshot:
+        exporter.export_snapshot(snapshot, args.dump_snapshot, args.pretty)
+        sys.exit(0)
+    export(snapshot, args.years, args.formats, args.out, args.sortby, args.lo, args.flatten)
@@ -0,0 +1,264 @@
+import gc
+import sys
+import json
+import struct
+import hashlib
+from array import array
+from itertools import accumulate, repeat
+
+# serialised trees: magic, builder version, sha256 of the body, then length-prefixed sections
+TREE_MAGIC = b"SOFT"
+BUILDER_VERSION = 2 # bump whenever the layout built by CurriculumTree changes, stored trees are then rebuilt
+HEADER = struct.Struct("<4sI32s")
+SECTION = struct.Struct("<Q")
+
+class CurriculumTree:
+    # Breadth-first layout: every node's children sit next to each other, so a node only
+    # needs the offset and count of its children. Per-node data is kept in columns.
+    __slots__ = ("items", "ids", "parents", "child_start", "child_count", "type_codes", "types")
+
+    def __init__(self, items, root):
+        self.items = items
+        ids = [root]
+        objs = []
+        for node_id in ids: # ids grows while it is walked, which makes this the breadth-first order
+            obj = items[node_id]
+            objs.append(obj)
+            if obj["children"]:
+                ids += obj["children"]
+        child_count = [len(obj["children"] or ()) for obj in objs]
+        type_index = {}
+        self.types = []
+        for node_type in dict.fromkeys(obj["type"] for obj in objs):
+            type_index[node_type] = len(self.types)
+            self.types.append(node_type)
+        self.ids = ids
+        # children of a node start right after the children of every node before it
+        self.child_start = array("i", accumulate(child_count[:-1], initial=1))
+        self.child_count = array("i", child_count)
+        self.parents = array("i", [-1])
+        for index, count in enumerate(child_count):
+            if count:
+                self.parents.extend(repeat(index, count))
+        self.type_codes = array("B", [type_index[obj["type"]] for obj in objs])
+
+    def dump(self, spans):
+        # spans: id -> (offset, length) of the item's json in the stored items payload. Only
+        # those are saved, the items are read back from the payload by load
+        offsets = array("q", (spans[node_id][0] for node_id in self.ids))
+        lengths = array("i", (spans[node_id][1] for node_id in self.ids))
+        sections = [self.parents, self.child_start, self.child_count, self.type_codes, offsets, lengths]
+        if sys.byteorder != "little":
+            sections = [array(a.typecode, a) for a in sections]
+            for a in sections:
+                a.byteswap()
+        sections = [a.tobytes() for a in sections]
+        sections.append(json.dumps([self.types, self.ids], separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+        body = b"".join(SECTION.pack(len(section)) + section for section in sections)
+        return HEADER.pack(TREE_MAGIC, BUILDER_VERSION, hashlib.sha256(body).digest()) + body
+
+    @classmethod
+    def load(cls, data, read_items):
+        # read_items(offsets, lengths) returns the items at those spans of the payload, in order.
+        # Raises ValueError for anything that is not a current, intact tree so the caller rebuilds it
+        if len(data) < HEADER.size:
+            raise ValueError("truncated tree")
+        magic, version, digest = HEADER.unpack_from(data)
+        if magic != TREE_MAGIC:
+            raise ValueError("not a serialised tree")
+        if version != BUILDER_VERSION:
+            raise ValueError(f"tree built by version {version}, current is {BUILDER_VERSION}")
+        body = memoryview(data)[HEADER.size:]
+        if hashlib.sha256(body).digest() != digest:
+            raise ValueError("tree checksum mismatch")
+        sections = []
+        offset = 0
+        while offset < len(body):
+            (length,) = SECTION.unpack_from(body, offset)
+            offset += SECTION.size
+            sections.append(body[offset:offset + length])
+            offset += length
+        arrays = []
+        for typecode, section in zip("iiiBqi", sections):
+            a = array(typecode)
+            a.frombytes(section)
+            if sys.byteorder != "little":
+                a.byteswap()
+            arrays.append(a)
+        self = cls.__new__(cls)
+        self.parents, self.child_start, self.child_count, self.type_codes, offsets, lengths = arrays
+        self.types, self.ids = json.loads(bytes(sections[6]))
+        enabled = gc.isenabled()
+        gc.disable() # the items are many small containers and none of them cyclic, collecting while parsing only costs time
+        try:
+            objs = read_items(offsets, lengths)
+        finally:
+            if enabled:
+                gc.enable()
+        if len(objs) != len(self.ids):
+            raise ValueError("tree does not match the items payload")
+        self.items = dict(zip(self.ids, objs))
+        return self
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def root(self):
+        return TreeNode(self, 0)
+
+    def node(self, index):
+        return TreeNode(self, index)
+
+    def type(self, index):
+        return self.types[self.type_codes[index]]
+
+    def children(self, index):
+        start = self.child_start[index]
+        return range(start, start + self.child_count[index])
+
+    def is_leaf(self, index):
+        return self.child_count[index] == 0
+
+    def preorder(self, index=0):
+        stack = [index]
+        while stack:
+            index = stack.pop()
+            yield index
+            stack.extend(reversed(self.children(index)))
+
+class TreeNode:
+    # Lightweight view of one position in a CurriculumTree, with the attributes the
+    # exporter and the ui used from anytree.Node
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, TreeNode) and self.tree is other.tree and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __repr__(self):
+        return f"TreeNode({self.name!r}, {self.index})"
+
+    @property
+    def name(self):
+        return self.tree.ids[self.index]
+
+    @property
+    def obj(self):
+        return self.tree.items[self.name]
+
+    @property
+    def type(self):
+        return self.tree.type(self.index)
+
+    @property
+    def title(self):
+        return self.obj.get("title")
+
+    @property
+    def subtitle(self):
+        return self.obj.get("subtitle")
+
+    @property
+    def uuid(self):
+        return self.obj.get("uuid")
+
+    @property
+    def parent(self):
+        parent = self.tree.parents[self.index]
+        return TreeNode(self.tree, parent) if parent >= 0 else None
+
+    @property
+    def children(self):
+        return tuple(TreeNode(self.tree, i) for i in self.tree.children(self.index))
+
+    @property
+    def child_count(self):
+        return self.tree.child_count[self.index]
+
+    @property
+    def is_leaf(self):
+        return self.tree.is_leaf(self.index)
+
+    @property
+    def is_root(self):
+        return self.tree.parents[self.index] < 0
+
+    @property
+    def root(self):
+        return self.tree.root
+
+UNCHECKED, CHECKED, TRISTATE = 0, 1, 2
+STATES = ("unchecked", "checked", "tristate")
+
+class CheckState:
+    # Check state of every node in a CurriculumTree, with per-node counts of checked and
+    # unchecked children so a toggle only walks the path to the root. Nodes whose state
+    # changed collect in `changed` until the view has redrawn them.
+    __slots__ = ("tree", "states", "checked_children", "unchecked_children", "changed")
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.states = array("B", bytes(len(tree)))
+        self.checked_children = array("i", bytes(4 * len(tree)))
+        self.unchecked_children = array("i", tree.child_count)
+        self.changed = set()
+
+    def __getitem__(self, index):
+        return self.states[index]
+
+    def set(self, index, state):
+        old = self.states[index]
+        if old == state:
+            return
+        self.states[index] = state
+        self.changed.add(index)
+        parent = self.tree.parents[index]
+        if parent < 0:
+            return
+        if old == CHECKED:
+            self.checked_children[parent] -= 1
+        elif old == UNCHECKED:
+            self.unchecked_children[parent] -= 1
+        if state == CHECKED:
+            self.checked_children[parent] += 1
+        elif state == UNCHECKED:
+            self.unchecked_children[parent] += 1
+
+    def check(self, index, descend):
+        self.set(index, CHECKED)
+        self.update_ancestors(index, CHECKED)
+        self.set_descendants(index, CHECKED, descend)
+
+    def uncheck(self, index, descend):
+        self.set(index, UNCHECKED)
+        self.set_descendants(index, UNCHECKED, descend)
+        self.update_ancestors(index, UNCHECKED)
+
+    def update_ancestors(self, index, state):
+        # a parent follows its children while they all agree, otherwise it and everything above it is tristate
+        parents = self.tree.parents
+        counts = self.checked_children if state == CHECKED else self.unchecked_children
+        parent = parents[index]
+        while parent >= 0 and counts[parent] == self.tree.child_count[parent]:
+            self.set(parent, state)
+            parent = parents[parent]
+        while parent >= 0:
+            self.set(parent, TRISTATE)
+            parent = parents[parent]
+
+    def set_descendants(self, index, state, descend):
+        # descend(index) decides whether the children of a node are reached, e.g. only open rows
+        stack = [index]
+        while stack:
+            index = stack.pop()
+            if descend(index):
+                for child in self.tree.children(index):
+                    self.set(child, state)
+                    stack.append(child)
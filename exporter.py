@@ -1,78 +1,156 @@
 import os
+import csv
+import sys
 import json
+import hashlib
+import shutil
+import tempfile
+import threading
+from concurrent import futures
 import pytz
 from datetime import datetime
-from anytree import Node, PreOrderIter
-from anytree.search import find
-from collections import deque, OrderedDict
-import pandas as pd
+from array import array
+import xlsxwriter
 import re
+import store
+import cache
+from curriculum import CurriculumTree, TreeNode, BUILDER_VERSION
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # optional, only the parquet export needs it
+    pa = pq = None
 
 json_name_dict = ["user", "curriculum-groups", "bundle-settings", "curriculum", "resources", "notes", "attachments", "learning-events", "calendar-events", "clinical"]
-FILE_TYPES = ["csv", "xlsx"]
+FILE_TYPES = ["csv", "xlsx", "parquet", "jsonl"]
 SORTBY_OPTIONS = ["None", "Alphabetical (A-Z)", "Alphabetical (Z-A)"]
 FLATTEN_OPTIONS = ["Intermediate-level"] # potentially Top-level flattening, but not that useful
 
-def get_files(responses: list, start_with="responses_", separator="_", uuid_search="user"):
+MANIFEST_NAME = "manifest.json"
+REQUIRED_ENDPOINTS = ["user", "items"] # a snapshot without them has no curriculum to list or export
+FAILED_PREFIX = "failed_" # responses_<epoch> folders that could not be stored are renamed aside with it
+MANIFEST_VERSION = 1
+SNAPSHOT_CACHE_BUDGET = int(os.environ.get("SOFIA_CACHE_MB", "256")) * 1024 * 1024
+XLSX_HEADER_FORMAT = {"bold": True, "border": 1, "align": "center", "valign": "top"} # what pandas gave header and index cells
+XLSX_CONSTANT_MEMORY = os.environ.get("SOFIA_XLSX_CONSTANT_MEMORY", "0") == "1" # flush every row to disk instead of keeping the workbook
+XLSX_RESERVED_SHEETS = ["History", "Level 1 Only", "Learning Objectives"] # Excel's own, then the two list sheets
+SHEET_NAME_LENGTH = 31
+PARQUET_BATCH = 65536 # rows per row group
+EXPORT_WORKERS = min(8, os.cpu_count() or 1) # writers of one export run side by side, a workbook or a csv file each
+INVALID_SHEET_CHARS = re.compile(r"[\[\]:*?/\\]")
+FILE_NAME_CHARS = re.compile(r'[<>:"/\\|?*\x00-\x1F\s]+')
+
+# parsed payloads and built year trees, so switching back to a year viewed before is instant
+snapshot_cache = cache.LRUCache(SNAPSHOT_CACHE_BUDGET)
+
+def write_atomic(file_path, data):
+    # readers never see a half written file: write next to it, then rename over it
+    tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def file_checksum(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def endpoint_name(file, separator="_"):
+    stem = os.path.splitext(file)[0]
+    stamp, sep, name = stem.partition(separator)
+    if sep and stamp.isdigit(): # raw capture file: <epoch_ns>_<endpoint>.json
+        return name
+    return stem
+
+def normalise_snapshot(folder_path, urls=None, validators=None, extra=None, separator="_", uuid_search="user"):
+    # Runs once per snapshot (end of scraping), renames the raw capture files and writes the manifest
+    files = [f for f in sorted(os.listdir(folder_path)) if f.endswith(".json") and f not in (MANIFEST_NAME, "items-cache.json")]
+    uuid = ""
+    for file in files:
+        if endpoint_name(file, separator) == uuid_search:
+            with open(os.path.join(folder_path, file), "r") as f:
+                uuid = str(json.load(f)["curriculum"])
+    endpoints = {}
+    endpoint_urls = {}
+    for file in files:
+        file_path = os.path.join(folder_path, file)
+        file_name = endpoint_name(file, separator)
+        if uuid and file_name == uuid:
+            with open(file_path, "r") as f:
+                json_dict = json.load(f)
+            file_name = "schemas" if "user_schema" in json_dict else "items"
+        new_file = f"{file_name}.json"
+        if file != new_file:
+            os.replace(file_path, os.path.join(folder_path, new_file))
+        endpoints[file_name] = new_file
+        if urls and file in urls:
+            endpoint_urls[file_name] = urls[file]
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "uuid-curriculum": uuid,
+        "endpoints": endpoints,
+    }
+    if not urls: # keep the urls/validators of a previous manifest when re-normalising
+        previous = read_manifest(folder_path) or {}
+        endpoint_urls = previous.get("urls", {})
+        validators = validators or previous.get("validators")
+        extra = extra or ({"capture": previous["capture"]} if "capture" in previous else None)
+    if endpoint_urls:
+        manifest["urls"] = endpoint_urls
+    if validators:
+        manifest["validators"] = validators
+    if extra:
+        manifest.update(extra)
+    for key in ("items", "schemas"):
+        if key in endpoints:
+            manifest[key] = endpoints[key]
+    manifest["checksums"] = {f: file_checksum(os.path.join(folder_path, f)) for f in sorted(set(endpoints.values()))}
+    write_atomic(os.path.join(folder_path, MANIFEST_NAME), json.dumps(manifest, indent=4).encode("utf-8"))
+    return manifest
+
+def read_manifest(folder_path):
+    manifest_path = os.path.join(folder_path, MANIFEST_NAME)
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def store_snapshot(folder_path, separator="_"):
+    # Moves a responses_<epoch> folder into the snapshot store, normalising it first if needed
+    manifest = read_manifest(folder_path)
+    if manifest is None: # snapshot from before manifests, or an older manifest version
+        print(f"Normalising snapshot {folder_path}")
+        manifest = normalise_snapshot(folder_path)
+    missing = [endpoint for endpoint in REQUIRED_ENDPOINTS if endpoint not in manifest["endpoints"]]
+    if missing:
+        raise ValueError(f"no {' or '.join(missing)} payload captured")
+    snapshot = os.path.basename(os.path.normpath(folder_path)).split(separator)[1]
+    store.ingest_snapshot(folder_path, snapshot, manifest)
+    precompute_trees(snapshot)
+    return snapshot
+
+def get_files(responses: list):
     path_dict = {}
-    for folder in responses:
-        folder_path = start_with+folder
-        folder_dict = {}
-        uuid = ""
-        for file in sorted(os.listdir(folder_path)):
-            file_path = os.path.join(folder_path, file)
-            if os.path.isfile(file_path):
-                file_split = os.path.splitext(file)
-                file_sep = file_split[0].split(separator)
-                print(f"{file_split}, {file_sep}")
-                if len(file_sep) > 1:
-                    file_name = file_sep[1]
-                else:
-                    file_name = file_sep[0]
-                print(file_path)
-                if file_name == uuid_search:
-                    with open(file_path, "r") as f:
-                        json_dict = json.load(f)
-                        uuid = str(json_dict['curriculum'])
-                elif file_name == uuid:
-                    print(f"Filename {file_path} is {uuid}")
-                    with open(file_path, "r") as f:
-                        json_dict = json.load(f)
-                    if "user_schema" in json_dict:
-                        print("user_schema")
-                        new_path = os.path.join(folder_path, "schemas.json")
-                        os.replace(file_path, new_path)
-                        with open(new_path, "w") as q:
-                            json.dump(json_dict, q, indent=4)
-                        folder_dict["schemas"] = new_path
-                    else:
-                        print("items")
-                        if len(file_sep) > 2:
-                            folder_dict["items-cache"] = file_path
-                            continue
-                        new_path = os.path.join(folder_path, "items.json")
-                        os.replace(file_path, new_path)
-                        print(f"items: {new_path}")
-                        with open(new_path, "w") as q:
-                            json.dump(json_dict, q, indent=4)
-                        folder_dict["items"] = new_path
-                        save_dir = os.path.join(folder_path, "items-cache.json")
-                        print(save_dir)
-                        print(new_path)
-                        if not os.path.isfile(save_dir):
-                            print(f"items-cache: {save_dir}")
-                            flip_dict_keys(new_path, save_dir)
-                            folder_dict["items-cache"] = save_dir
-                    continue
-                new_path = os.path.join(folder_path, f"{file_name}.json")
-                with open(file_path, "r") as q:
-                    old_json = json.load(q)
-                os.replace(file_path, new_path)
-                with open(new_path, "w") as q:
-                    json.dump(old_json, q, indent=4)
-                folder_dict[file_name] = new_path
-        folder_dict['uuid-curriculum'] = uuid
-        path_dict[folder] = folder_dict
+    for response in responses:
+        manifest = store.manifest(response)
+        if manifest is None:
+            continue
+        path_dict[response] = {
+            "snapshot": response,
+            "uuid-curriculum": manifest["uuid-curriculum"],
+            "endpoints": sorted(manifest["endpoints"]),
+        }
     return path_dict
 
 def epoch_to_datetime(epoch, timezone="Europe/London"):
@@ -85,31 +163,33 @@ def datetime_to_epoch(dt, timezone="Europe/London"):
     dtime = timezone.localize(dtime.replace(tzinfo=None))
     return int(dtime.timestamp())
 
-def flip_dict_keys(file_dir, save_dir):
-    with open(file_dir, "r") as f:
-        json_data = json.load(f)
-        new_dict = {v["uuid"]: {"id": k, **v} for k, v in json_data.items()}
-    with open(save_dir, "w") as f:
-        json.dump(new_dict, f, indent=4)
+def export_snapshot(response, save_dir, pretty=True):
+    # snapshots are stored as received, this writes a readable (or plain) copy of one
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    for endpoint, data in store.payloads(response):
+        new_path = os.path.join(save_dir, f"{endpoint}.json")
+        if pretty:
+            with open(new_path, "w") as f:
+                json.dump(json.loads(data), f, indent=4)
+        else:
+            write_atomic(new_path, data)
+    print(f"EXPORT: snapshot {response} copied to '{save_dir}'")
 
 def create_tree(tree_dict, root):
-    root = Node(root, parent=None, obj=tree_dict[root])
-    queue = deque([root])
-    while queue:
-        node = queue.popleft()
-        if node.obj["children"] == None:
-            continue
-        for x in node.obj["children"]:
-            child_node = Node(x, parent=node, obj=tree_dict[x])
-            queue.append(child_node)
-    return root
+    return CurriculumTree(tree_dict, root).root
 
-def properties(root_node, node_id):
-    return find(root_node, filter_=lambda node: node.name == node_id)
+def cached_payload(snapshot, endpoint):
+    checksum = store.manifest_checksum(snapshot)
+    data = snapshot_cache.get((snapshot, endpoint), checksum)
+    if data is None:
+        data = store.payload_json(snapshot, endpoint)
+        if data is not None:
+            snapshot_cache.put((snapshot, endpoint), data, cache.deep_size(data), checksum)
+    return data
 
 def get_curriculum(link_dict):
-    with open(link_dict["user"], "r") as f:
-        json_data = json.load(f)
+    json_data = cached_payload(link_dict["snapshot"], "user")
     steps = json_data["steps"]
     statement = []
     for index, element in enumerate(steps):
@@ -118,59 +198,119 @@ def get_curriculum(link_dict):
         statement.append(f"{code}/{curriculum}")
     return steps, statement
 
+def set_aside(folder_path):
+    # kept for inspection, but renamed so it is not retried on every listing
+    head, folder = os.path.split(os.path.normpath(folder_path))
+    failed_path = os.path.join(head, FAILED_PREFIX + folder)
+    os.replace(folder_path, failed_path)
+    print(f"Moved {folder_path} to {failed_path}")
+
 def get_responses(directory=".", start_with="responses_", separator="_"):
-    responses = []
-    for folder in sorted(os.listdir(directory), reverse=True):
-        if folder.startswith(start_with):
-            response_time = folder.split(separator)[1]
-            responses.append(response_time)
-    return responses
+    # folders left by older versions (or an interrupted scrape) are moved into the store first
+    for folder in sorted(os.listdir(directory)):
+        folder_path = os.path.join(directory, folder)
+        if folder.startswith(start_with) and os.path.isdir(folder_path):
+            try:
+                store_snapshot(folder_path, separator)
+            except (OSError, ValueError, KeyError) as exc:
+                print(f"Could not store {folder_path}: {exc}")
+                set_aside(folder_path)
+    return store.snapshots(endpoints=REQUIRED_ENDPOINTS)
 
 def get_tree(response: list, select_year: int):
     paths = get_files(response)
     link_dict = paths[response[0]]
     steps, _ = get_curriculum(link_dict)
     uuid = steps[select_year]["uuid"]
-    with open(link_dict["items-cache"], "r") as f:
-        json_data = json.load(f)
-    try:
-        entry_id = json_data[uuid]["id"]
-    except KeyError:
+    snapshot = link_dict["snapshot"]
+    checksum = store.manifest_checksum(snapshot)
+    root_node = snapshot_cache.get((snapshot, uuid), checksum)
+    if root_node is not None:
+        return root_node
+    tree = year_tree(snapshot, uuid)
+    if tree is None:
         print("Uuid item not found")
         return
-    with open(link_dict["items"], "r") as f:
-        items_json = json.load(f)
-    root_node = create_tree(items_json, entry_id)
+    root_node = tree.root
+    snapshot_cache.put((snapshot, uuid), root_node, tree_size(tree), checksum)
     return root_node
 
-def extract_paths(node, lo):
+def year_tree(snapshot, uuid):
+    # loads the tree stored for this step, rebuilding it when it is missing, stale or damaged
+    blob = store.items_blob(snapshot)
+    data = store.tree(blob, uuid)
+    if data is not None:
+        try:
+            return CurriculumTree.load(data, lambda offsets, lengths: store.read_items(snapshot, offsets, lengths))
+        except ValueError as exc:
+            print(f"Rebuilding tree {uuid}: {exc}")
+    entry_id = store.item_id(snapshot, uuid)
+    if entry_id is None:
+        return None
+    ids, offsets, lengths = zip(*store.subtree_spans(snapshot, entry_id))
+    tree = create_tree(dict(zip(ids, store.read_items(snapshot, offsets, lengths))), entry_id).tree
+    store.save_tree(blob, uuid, BUILDER_VERSION, tree.dump(dict(zip(ids, zip(offsets, lengths)))))
+    return tree
+
+def precompute_trees(snapshot):
+    # every year of the snapshot is built once at ingest, opening it later is a single load
+    blob = store.items_blob(snapshot)
+    user = store.payload_json(snapshot, "user")
+    if blob is None or user is None:
+        return
+    for step in user.get("steps", []):
+        if store.tree_version(blob, step["uuid"]) != BUILDER_VERSION:
+            year_tree(snapshot, step["uuid"])
+
+def tree_size(tree):
+    # the columns share their strings with the parsed items
+    columns = sum(sys.getsizeof(getattr(tree, name)) for name in CurriculumTree.__slots__ if name != "items")
+    return columns + cache.sampled_size(tree.items)
+
+def iter_paths(node, lo, selected=None):
+    # Depth-first walk carrying the path below the nearest year (Y) node and the learning objectives (O)
+    # on it, so a leaf never climbs back up. Yields (key, path, lo_path) for every leaf in preorder, key
+    # being the tuple of node ids on the path. selected: optional check state per node index (0 = unchecked),
+    # unselected subtrees are skipped and a node counts as a leaf once none of its children are selected
+    tree = node.tree
+    stack = [(node.index, (), (), ())] # (index, ids on the path, path, learning objectives)
+    while stack:
+        index, key, path, lo_path = stack.pop()
+        match tree.type(index):
+            case "Y":
+                key, path, lo_path = (), (), ()
+            case "O":
+                if lo:
+                    lo_path += (TreeNode(tree, index),)
+            case _:
+                key += (tree.ids[index],)
+                path += (TreeNode(tree, index),)
+        children = tree.children(index)
+        if selected is not None:
+            children = [child for child in children if selected[child]]
+        if not children:
+            yield key, list(path), list(lo_path)
+            continue
+        stack.extend((child, key, path, lo_path) for child in reversed(children))
+
+def extract_paths(node, lo, selected=None):
     paths = {} # list of all the nodes, each arranged in a hierachy list
     spreadsheet_name = node.obj["title"]
-    for leaf in PreOrderIter(node, filter_=lambda n: n.is_leaf):
-        path = []
-        lo_path = []
-        current = leaf
-        while current:
-            obj_type = current.obj["type"]
-            if obj_type == "Y":
-                break
-            elif obj_type == "O":
-                if lo:
-                    lo_path.append(current)
-                current = current.parent
-                continue
-            path.append(current) # Append nodes into a list of hierarchy
-            current = current.parent
-        if str(path[::-1]) not in paths:
-            paths[str(path[::-1])] = {
-                "path": path[::-1],
-                "lo_path": lo_path[::-1]
-            }  # Reverse to get root to leaf order
+    for key, path, lo_path in iter_paths(node, lo, selected):
+        if key not in paths:
+            paths[key] = {
+                "path": path,
+                "lo_path": lo_path
+            }
         elif len(lo_path) > 0:
-            paths[str(path[::-1])]["lo_path"].extend(lo_path[::-1])
+            paths[key]["lo_path"].extend(lo_path)
     return (paths, spreadsheet_name)
 
 def level_flattening(paths, flatten):
+    # Yields (sheet, table, row, node) records in path order instead of collecting them: ("level1", None, title) for
+    # paths of a single node, ("Learning Objectives", None, title) for every learning objective, numbered in the
+    # order they are yielded, and (top-level title, bottom-level title, entry) for everything else. node is the
+    # TreeNode the row was made from, for the formats that keep ids
     try:
         flatten_index = FLATTEN_OPTIONS.index(flatten)
     except ValueError:
@@ -178,18 +318,16 @@ def level_flattening(paths, flatten):
         flatten_index = 0
     match flatten_index:
         case _: #Intermediate-level
-            data_dict = {}
+            lo_count = 0
             for key, path_dict in paths.items():
                 path = path_dict["path"]
                 lo_path = path_dict["lo_path"]
                 if len(path) == 1:
-                    if "level1" not in data_dict:
-                        data_dict["level1"] = []
-                    data_dict["level1"].append(path[0].obj["title"])
+                    yield "level1", None, path[0].obj["title"], path[0]
                     continue
                 if len(path) > 1:
                     top_level = path[0]
-                    row = path[-1]
+                    node = row = path[-1]
                     if "title" in row.obj and row.obj["title"] != "":
                         row = row.obj["title"]
                     else:
@@ -200,142 +338,362 @@ def level_flattening(paths, flatten):
                     bottom_level = path[1].obj["title"]
                 if len(path) > 3:
                     grouping = " > ".join([n.obj["title"] for n in path[2:-1]])
-                top_level_name = top_level.obj["title"][:31]
-                if top_level_name not in data_dict:
-                    data_dict[top_level_name] = {}
-                if bottom_level not in data_dict[top_level_name]:
-                    data_dict[top_level_name][bottom_level] = []
+                top_level_name = top_level.obj["title"]
                 entry = {
                         bottom_level: row,
                 }
                 if grouping != "":
                     entry["Grouping"] = grouping # Combine intermediate levels starting from level 2 to n -1, where n is index of row
                 if len(lo_path) > 0:
-                    if "Learning Objectives" not in data_dict:
-                        data_dict["Learning Objectives"] = []
-                    prev_index = len(data_dict["Learning Objectives"])
-                    new_index = prev_index + len(lo_path)
-                    data_dict["Learning Objectives"].extend([i.obj["title"] if len(i.obj["title"]) > 0 else i.obj["subtitle"] for i in lo_path])
-                    entry["Learning Objectives"] = " ,".join(map(str, range(prev_index, new_index)))
-                data_dict[top_level_name][bottom_level].append(entry) # top-level = sheet name, bottom_level = column header
-            return data_dict
-
-def sofia_exporter(file_path, data_dict, sortby, file_type):
+                    entry["Learning Objectives"] = " ,".join(map(str, range(lo_count, lo_count + len(lo_path))))
+                    lo_count += len(lo_path)
+                    for i in lo_path:
+                        yield "Learning Objectives", None, i.obj["title"] if len(i.obj["title"]) > 0 else i.obj["subtitle"], i
+                yield top_level_name, bottom_level, entry, node # top-level = sheet name, bottom_level = column header
+
+def sheet_names(titles, reserved=()):
+    # top-level title -> a sheet name Excel accepts: none of []:*?/\, no apostrophe at either end, at most
+    # 31 characters and unique ignoring case, clashes get " (2)", " (3)"... Csv files are named the same way.
+    taken = {name.lower() for name in reserved}
+    names = {}
+    for title in titles:
+        base = INVALID_SHEET_CHARS.sub("_", str(title))[:SHEET_NAME_LENGTH].strip("'") or "Sheet"
+        name = base
+        count = 1
+        while name.lower() in taken:
+            count += 1
+            suffix = f" ({count})"
+            name = base[:SHEET_NAME_LENGTH - len(suffix)] + suffix
+        taken.add(name.lower())
+        names[title] = name
+    return names
+
+class RowSpool:
+    # Records are appended to a file as they arrive and only their offsets stay in memory. Writers read
+    # them back one table at a time once the last record is in, since a sheet lists its tables one after
+    # another and a table needs all of its columns before the header is written. Every writer opens its
+    # own reader, so several can read the same spool at once.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.tables = {} # sheet -> {table -> array of row offsets}
+        self.columns = {} # (sheet, table) -> columns in the order they first appear, as a DataFrame of the rows had them
+
+    def add(self, sheet, table, row):
+        tables = self.tables.setdefault(sheet, {})
+        if table not in tables:
+            tables[table] = array("q")
+            self.columns[(sheet, table)] = {}
+        tables[table].append(self.file.tell())
+        if isinstance(row, dict):
+            self.columns[(sheet, table)].update(dict.fromkeys(row))
+        self.file.write(json.dumps(row, ensure_ascii=False).encode("utf-8") + b"\n")
+
+    def finish(self):
+        self.file.close()
+
+    def reader(self):
+        return open(self.path, "rb")
+
+    def sheets(self):
+        # learning objectives, level 1, then the top levels alphabetically
+        first = [sheet for sheet in ("Learning Objectives", "level1") if sheet in self.tables]
+        return first + sorted(sheet for sheet in self.tables if sheet not in first)
+
+    def table_names(self, sheet):
+        tables = list(self.tables[sheet])
+        if "Values" in tables:
+            tables.remove("Values")
+            tables.insert(0, "Values")
+        return tables
+
+    def table(self, reader, sheet, table, sortby_index=0):
+        # (columns, rows) of one table, columns follow the order the rows come out in
+        rows = self.read(reader, self.tables[sheet][table])
+        match sortby_index:
+            case 1: #Alphabetical (A-Z), sorting needs the whole table but never more than one
+                rows = sorted(rows, key=lambda i: i[table])
+            case 2: #Alphabetical (Z-A)
+                rows = sorted(rows, key=lambda i: i[table], reverse=True)
+            case _: #None
+                return list(self.columns[(sheet, table)]), rows
+        columns = {}
+        for row in rows:
+            columns.update(dict.fromkeys(row))
+        return list(columns), rows
+
+    def read(self, reader, offsets):
+        for offset in offsets:
+            reader.seek(offset)
+            yield json.loads(reader.readline())
+
+def publish(staged, target):
+    # moves a finished export into place, a csv folder already at the target is swapped out and removed
+    if os.path.isdir(target):
+        old = staged + ".old"
+        os.rename(target, old)
+        os.rename(staged, target)
+        shutil.rmtree(old)
+    else:
+        os.replace(staged, target)
+
+class CsvExport:
+    # Level 1 titles and learning objectives are one list each and go straight to their files. The tables
+    # of the top levels are read back from the spool in finish(), one job per file so files can be written in parallel.
+    def __init__(self, file_path, spool, sortby_index):
+        os.makedirs(file_path)
+        self.file_path = file_path
+        self.spool = spool
+        self.sortby_index = sortby_index
+        self.files = {} # sheet -> [file, csv writer, rows written]
+
+    def add(self, sheet, table, row, node):
+        match sheet:
+            case "level1" | "Learning Objectives":
+                if sheet not in self.files:
+                    self.open_list(sheet)
+                _, writer, count = self.files[sheet]
+                writer.writerow([row] if sheet == "level1" else [count, row])
+                self.files[sheet][2] += 1
+
+    def open_list(self, sheet):
+        name, header = ("level_1_only.csv", ["0"]) if sheet == "level1" else ("learning_objectives.csv", ["", "0"])
+        print(f"{sheet}")
+        f = open(os.path.join(self.file_path, name), "w", newline="", encoding="utf-8")
+        writer = csv.writer(f, lineterminator=os.linesep)
+        writer.writerow(header)
+        self.files[sheet] = [f, writer, 0]
+
+    def finish(self):
+        for f, _, _ in self.files.values():
+            f.close()
+        files = {} # file name -> top levels, different names can still clean up to the same file
+        for top_level, name in sheet_names(sheet for sheet in self.spool.sheets() if sheet not in ("level1", "Learning Objectives")).items():
+            files.setdefault(FILE_NAME_CHARS.sub("_", name), []).append(top_level)
+        return [lambda name=name, top_levels=top_levels: self.write_file(name, top_levels) for name, top_levels in files.items()]
+
+    def write_file(self, name, top_levels):
+        with self.spool.reader() as reader, open(os.path.join(self.file_path, f"{name}.csv"), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f, lineterminator=os.linesep)
+            for top_level in top_levels:
+                print(f"{top_level}")
+                for bottom_level in self.spool.table_names(top_level):
+                    columns, rows = self.spool.table(reader, top_level, bottom_level, self.sortby_index)
+                    writer.writerow(columns)
+                    writer.writerows([row.get(column) for column in columns] for row in rows)
+                    f.write(os.linesep)
+
+    def publish(self, file_path):
+        publish(self.file_path, file_path)
+        print(f"EXPORT: CSV files to directory '{file_path}' created successfully.")
+
+class XlsxExport:
+    # Sheets have to be created in their final order, so the workbook is only written once the spool is complete.
+    # Tables of a top level are stacked on its sheet with a blank row between them. Cells are written strictly row
+    # by row, which is what XlsxWriter's constant_memory mode needs: each row then goes to disk as soon as the
+    # next one starts, at the cost of a larger file since strings are stored inline.
+    def __init__(self, file_path, spool, sortby_index, constant_memory=XLSX_CONSTANT_MEMORY):
+        self.file_path = file_path + ".xlsx"
+        self.spool = spool
+        self.sortby_index = sortby_index
+        self.constant_memory = constant_memory
+
+    def add(self, sheet, table, row, node):
+        pass
+
+    def finish(self):
+        return [self.write_workbook]
+
+    def write_workbook(self):
+        workbook = xlsxwriter.Workbook(self.file_path, {"constant_memory": self.constant_memory})
+        header = workbook.add_format(XLSX_HEADER_FORMAT)
+        names = sheet_names([sheet for sheet in self.spool.sheets() if sheet not in ("level1", "Learning Objectives")], XLSX_RESERVED_SHEETS)
+        with self.spool.reader() as reader:
+            for top_level in self.spool.sheets():
+                print(f"{top_level}")
+                match top_level:
+                    case "level1":
+                        worksheet = workbook.add_worksheet("Level 1 Only")
+                        worksheet.write(0, 0, 0, header)
+                        for i, row in enumerate(self.spool.read(reader, self.spool.tables[top_level][None]), 1):
+                            worksheet.write(i, 0, row)
+                    case "Learning Objectives":
+                        worksheet = workbook.add_worksheet("Learning Objectives")
+                        worksheet.write(0, 1, 0, header)
+                        for i, row in enumerate(self.spool.read(reader, self.spool.tables[top_level][None])):
+                            worksheet.write(i + 1, 0, i, header)
+                            worksheet.write(i + 1, 1, row)
+                    case _:
+                        worksheet = workbook.add_worksheet(names[top_level])
+                        last_row = 0
+                        for bottom_level in self.spool.table_names(top_level):
+                            columns, rows = self.spool.table(reader, top_level, bottom_level, self.sortby_index)
+                            for col, column in enumerate(columns):
+                                worksheet.write(last_row, col, column, header)
+                            for row in rows:
+                                last_row += 1
+                                for col, column in enumerate(columns):
+                                    worksheet.write(last_row, col, row.get(column))
+                            last_row += 2
+        workbook.close()
+
+    def publish(self, file_path):
+        publish(self.file_path, file_path + ".xlsx")
+        print(f"EXPORT: Excel file '{file_path}.xlsx' created successfully.")
+
+def node_path(node):
+    # ids of the nodes from below the year down to node, learning objectives left out as in extract_paths
+    tree, index = node.tree, node.index
+    ids = []
+    while index >= 0 and tree.type(index) != "Y":
+        if tree.type(index) != "O":
+            ids.append(tree.ids[index])
+        index = tree.parents[index]
+    return ids[::-1]
+
+def long_row(sheet, table, row, node, lo_index):
+    # One row of the long format: the node, where it ended up in the sheets and the learning objectives it refers to.
+    # learning_objectives are lo_index numbers of the objective rows, as in the "Learning Objectives" column.
+    match sheet:
+        case "level1":
+            top_level, bottom_level, title, grouping, objectives = row, None, row, None, []
+        case "Learning Objectives":
+            top_level, bottom_level, title, grouping, objectives = None, None, row, None, []
+        case _:
+            top_level, bottom_level, title, grouping = sheet, table, row[table], row.get("Grouping")
+            objectives = [int(i) for i in row["Learning Objectives"].split(" ,")] if "Learning Objectives" in row else []
+    return {
+        "id": node.name,
+        "type": node.type,
+        "code": node.obj.get("code"),
+        "title": title,
+        "top_level": top_level,
+        "bottom_level": bottom_level,
+        "grouping": grouping,
+        "path": node_path(node),
+        "learning_objectives": objectives,
+        "lo_index": lo_index,
+    }
+
+class LongExport:
+    # The whole export as one table in long format, a row per record written as it arrives. Subclasses write the rows.
+    def __init__(self, file_path, extension):
+        self.file_path = file_path + extension
+        self.extension = extension
+        self.lo_count = 0
+
+    def add(self, sheet, table, row, node):
+        lo_index = None
+        if sheet == "Learning Objectives":
+            lo_index = self.lo_count
+            self.lo_count += 1
+        self.write(long_row(sheet, table, row, node, lo_index))
+
+    def publish(self, file_path):
+        publish(self.file_path, file_path + self.extension)
+        print(f"EXPORT: {self.extension[1:]} file '{file_path}{self.extension}' created successfully.")
+
+class JsonlExport(LongExport):
+    def __init__(self, file_path):
+        super().__init__(file_path, ".jsonl")
+        self.file = open(self.file_path, "w", encoding="utf-8")
+
+    def write(self, row):
+        self.file.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def finish(self):
+        self.file.close()
+        return []
+
+class ParquetExport(LongExport):
+    # Rows are collected per column and written as a row group every PARQUET_BATCH rows. Columns that repeat
+    # a few values over and over are dictionary types, so they load as categories.
+    def __init__(self, file_path):
+        super().__init__(file_path, ".parquet")
+        labels = pa.dictionary(pa.int32(), pa.string())
+        self.schema = pa.schema([
+            ("id", pa.string()),
+            ("type", labels),
+            ("code", pa.string()),
+            ("title", pa.string()),
+            ("top_level", labels),
+            ("bottom_level", labels),
+            ("grouping", labels),
+            ("path", pa.list_(pa.string())),
+            ("learning_objectives", pa.list_(pa.int32())),
+            ("lo_index", pa.int32()),
+        ])
+        self.writer = pq.ParquetWriter(self.file_path, self.schema, compression="zstd")
+        self.columns = {name: [] for name in self.schema.names}
+        self.count = 0
+
+    def write(self, row):
+        for name, values in self.columns.items():
+            values.append(row[name])
+        self.count += 1
+        if self.count == PARQUET_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.count:
+            self.writer.write_table(pa.Table.from_pydict(self.columns, schema=self.schema))
+            for values in self.columns.values():
+                values.clear()
+            self.count = 0
+
+    def finish(self):
+        self.flush()
+        self.writer.close()
+        return []
+
+def sofia_exporter(file_path, rows, sortby, file_type):
+    # rows: (sheet, table, row, node) records as yielded by level_flattening, consumed as they come.
+    # file_type: one of FILE_TYPES or a list of them, every format is written from the same single pass over rows.
+    # Everything goes to a staging folder next to file_path first and is only moved into place once complete.
+    file_indexes = []
+    for file_type in [file_type] if isinstance(file_type, str) else file_type:
+        try:
+            file_indexes.append(FILE_TYPES.index(file_type))
+        except ValueError:
+            print("Invalid filetype index")
+            file_indexes.append(0)
     try:
-        file_index = FILE_TYPES.index(file_type)
+        sortby_index = SORTBY_OPTIONS.index(sortby)
     except ValueError:
-        print("Invalid filetype index")
-        file_index = 0
-    match file_index:
-        case 0:
-            if not os.path.exists(file_path):
-                os.makedirs(file_path)
-            if "Learning Objectives" in data_dict:
-                    temp_dict = OrderedDict([("Learning Objectives", data_dict["Learning Objectives"])])
-            if "level1" in data_dict:
-                try:
-                    temp_dict["level1"] = data_dict["level1"]
-                except NameError:
-                    temp_dict = OrderedDict([("level1", data_dict["level1"])])
-            try:
-                temp_dict
-                for k, v in sorted(data_dict.items()):
-                    if k != "level1" or k != "Learning Objectives":
-                        temp_dict[k] = v
-                data_dict = temp_dict
-            except NameError:
-                data_dict = sorted(data_dict.items())
-                pass
-            for top_level, sheet_data in data_dict.items():
-                print(f"{top_level}")
-                if top_level == "level1":
-                    df = pd.DataFrame(sheet_data)
-                    path = os.path.join(file_path, "level_1_only.csv")
-                    df.to_csv(path, index=False)
-                    continue
-                elif top_level == "Learning Objectives":
-                    df = pd.DataFrame(sheet_data)
-                    path = os.path.join(file_path, "learning_objectives.csv")
-                    df.to_csv(path, index=True)
-                    continue
-                if "Values" in sheet_data:
-                    temp_dict = OrderedDict([("Values", sheet_data["Values"])])
-                    for k, v in sheet_data.items():
-                        if k != "Values":
-                            temp_dict[k] = v
-                    sheet_data = temp_dict
-                for bottom_level, table_data in sheet_data.items():
-                    try:
-                        sortby_index = SORTBY_OPTIONS.index(sortby)
-                    except ValueError:
-                        print("Invalid sortby option")
-                        sortby_index = 0
-                    match sortby_index:
-                        case 1: #Alphabetical (A-Z)
-                            table_data = sorted(table_data, key=lambda i: i[bottom_level])
-                        case 2: #Alphabetical (Z-A)
-                            table_data = sorted(table_data, key=lambda i: i[bottom_level], reverse=True)
-                        case _: #None
-                            pass
-                    print(f"{bottom_level}: {table_data}")
-                    df = pd.DataFrame(table_data)
-                    top_level = re.sub(r'[<>:"/\\|?*\x00-\x1F\s]+', '_', top_level)
-                    path = os.path.join(file_path, f"{top_level}.csv")
-                    df.to_csv(path, mode="a", index=False)
-                    with open(path, 'a') as f:
-                        f.write("\n")
-            print(f"EXPORT: CSV files to directory '{file_path}' created successfully.")
-        case 1:
-            file_path = file_path + ".xlsx"
-            with pd.ExcelWriter(file_path) as writer:
-                if "Learning Objectives" in data_dict:
-                    temp_dict = OrderedDict([("Learning Objectives", data_dict["Learning Objectives"])])
-                if "level1" in data_dict:
-                    try:
-                        temp_dict["level1"] = data_dict["level1"]
-                    except NameError:
-                        temp_dict = OrderedDict([("level1", data_dict["level1"])])
-                try:
-                    temp_dict
-                    for k, v in sorted(data_dict.items()):
-                        if k != "level1" or k != "Learning Objectives":
-                            temp_dict[k] = v
-                    data_dict = temp_dict
-                except NameError:
-                    data_dict = sorted(data_dict.items())
-                    pass
-                for top_level, sheet_data in data_dict.items():
-                    last_row = 0
-                    print(f"{top_level}")
-                    if top_level == "level1":
-                        df = pd.DataFrame(sheet_data)
-                        df.to_excel(writer, sheet_name="Level 1 Only", index=False)
-                        continue
-                    elif top_level == "Learning Objectives":
-                        df = pd.DataFrame(sheet_data)
-                        df.to_excel(writer, sheet_name="Learning Objectives", index=True)
+        print("Invalid sortby option")
+        sortby_index = 0
+    folder, name = os.path.split(file_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f".{name}.", dir=folder or ".")
+    try:
+        spool = RowSpool(os.path.join(staging, "rows.spool"))
+        exports = []
+        for file_index in dict.fromkeys(file_indexes):
+            match file_index:
+                case 0:
+                    exports.append(CsvExport(os.path.join(staging, name), spool, sortby_index))
+                case 1:
+                    exports.append(XlsxExport(os.path.join(staging, name), spool, sortby_index))
+                case 2:
+                    if pa is None:
+                        print("EXPORT: parquet needs pyarrow (pip install pyarrow), skipped.")
                         continue
-                    if "Values" in sheet_data:
-                        temp_dict = OrderedDict([("Values", sheet_data["Values"])])
-                        for k, v in sheet_data.items():
-                            if k != "Values":
-                                temp_dict[k] = v
-                        sheet_data = temp_dict
-                    for bottom_level, table_data in sheet_data.items():
-                        try:
-                            sortby_index = SORTBY_OPTIONS.index(sortby)
-                        except ValueError:
-                            print("Invalid sortby option")
-                            sortby_index = 0
-                        match sortby_index:
-                            case 1: #Alphabetical (A-Z)
-                                table_data = sorted(table_data, key=lambda i: i[bottom_level])
-                            case 2: #Alphabetical (Z-A)
-                                table_data = sorted(table_data, key=lambda i: i[bottom_level], reverse=True)
-                            case _: #None
-                                pass
-                        print(f"{bottom_level}: {table_data}")
-                        df = pd.DataFrame(table_data)
-                        df.to_excel(writer, sheet_name=top_level, startrow=last_row, index=False)
-                        last_row += df.shape[0] + 2
-            print(f"EXPORT: Excel file '{file_path}' created successfully.")
\ No newline at end of file
+                    exports.append(ParquetExport(os.path.join(staging, name)))
+                case 3:
+                    exports.append(JsonlExport(os.path.join(staging, name)))
+        try:
+            for sheet, table, row, node in rows:
+                spool.add(sheet, table, row)
+                for export in exports:
+                    export.add(sheet, table, row, node)
+        finally:
+            spool.finish()
+        jobs = [job for export in exports for job in export.finish()]
+        with futures.ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export") as pool:
+            for future in [pool.submit(job) for job in jobs]:
+                future.result()
+        for export in exports:
+            export.publish(file_path)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import http.server
+from concurrent import futures
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import exporter
+import store
+
+MAX_WORKERS = 4
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+TIMEOUT = 30
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+def create_session(cookies=(), user_agent=None, max_workers=MAX_WORKERS):
+    session = requests.Session()
+    retry = Retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR, status_forcelist=RETRY_STATUSES, allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept"] = "application/json"
+    if user_agent:
+        session.headers["User-Agent"] = user_agent
+    for cookie in cookies:
+        session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain", ""), path=cookie.get("path", "/"))
+    return session
+
+def session_from_driver(driver, target_url, max_workers=MAX_WORKERS):
+    # Network.getAllCookies also returns the cookies of hosts the driver is not currently on
+    cookies = driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+    host = urlparse(target_url).hostname
+    if not any(host.endswith(c["domain"].lstrip(".")) for c in cookies):
+        driver.get(target_url) # sign-on has not reached sofia yet, let it set its session cookie
+        cookies = driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+    user_agent = driver.execute_script("return navigator.userAgent")
+    return create_session(cookies, user_agent, max_workers)
+
+def conditional_headers(validator):
+    headers = {}
+    if validator.get("ETag"):
+        headers["If-None-Match"] = validator["ETag"]
+    if validator.get("Last-Modified"):
+        headers["If-Modified-Since"] = validator["Last-Modified"]
+    return headers
+
+def fetch_endpoint(session, name, url, validator, save_dir, previous_snapshot=None):
+    headers = conditional_headers(validator) if previous_snapshot else {}
+    response = session.get(url, headers=headers, timeout=TIMEOUT)
+    file_path = os.path.join(save_dir, f"{name}.json")
+    if response.status_code == 304:
+        exporter.write_atomic(file_path, store.payload(previous_snapshot, name))
+        return name, validator, False
+    response.raise_for_status()
+    # an expired sign-on answers 200 with its html login page, which must not end up in a snapshot
+    content_type = response.headers.get("Content-Type", "")
+    if "application/json" not in content_type:
+        raise ValueError(f"{name} returned {content_type or 'no content type'} instead of json")
+    response.json() # raises ValueError when the body does not parse
+    exporter.write_atomic(file_path, response.content)
+    validator = {k: response.headers[k] for k in ("ETag", "Last-Modified") if k in response.headers}
+    return name, validator, True
+
+def replay_snapshot(session, previous, save_dir, max_workers=MAX_WORKERS):
+    # previous: stored manifest of the snapshot whose urls get replayed, validators come from it too
+    urls = previous["urls"]
+    validators = previous.get("validators", {})
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    start_time = time.time()
+    new_validators = {}
+    changed = []
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        jobs = []
+        for name, url in urls.items():
+            previous_snapshot = previous["snapshot"] if name in previous["endpoints"] else None
+            jobs.append(executor.submit(fetch_endpoint, session, name, url, validators.get(name, {}), save_dir, previous_snapshot))
+        for job in futures.as_completed(jobs):
+            name, validator, modified = job.result()
+            if validator:
+                new_validators[name] = validator
+            if modified:
+                changed.append(name)
+    exporter.normalise_snapshot(save_dir, urls={f"{k}.json": v for k, v in urls.items()}, validators=new_validators)
+    snapshot = exporter.store_snapshot(save_dir)
+    print(f"Replayed {len(urls)} endpoints ({len(changed)} changed) in {time.time() - start_time} seconds")
+    return snapshot
+
+def latest_replayable():
+    for response in store.snapshots():
+        manifest = store.manifest(response)
+        if manifest.get("urls"):
+            return {"snapshot": response, **manifest}
+    return None
+
+# stub api for the check below: fixed json with an ETag, 304 on a matching If-None-Match,
+# a 503 before the first answer of every path in FLAKY and text/html for every path in HTML
+STUB_PAYLOADS = {
+    "user": {"curriculum": "stub", "steps": [{"uuid": "year-1", "code": "Y1", "curriculum": "stub"}]},
+    "items": {"1": {"type": "Y", "uuid": "year-1", "title": "Year 1", "subtitle": "", "children": ["2"]},
+              "2": {"type": "T", "uuid": "topic-2", "title": "Topic", "subtitle": "", "children": None}},
+    "resources": [{"id": 1}],
+}
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    flaky = set()
+    html = set()
+    hits = []
+
+    def do_GET(self):
+        name = self.path.strip("/")
+        self.hits.append((name, self.headers.get("If-None-Match")))
+        if name in self.flaky:
+            self.flaky.discard(name)
+            self.send_response(503)
+            self.end_headers()
+            return
+        if name in self.html:
+            self.reply(200, "text/html", b"<html>sign in</html>")
+            return
+        data = json.dumps(STUB_PAYLOADS[name]).encode("utf-8")
+        etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.reply(200, "application/json", data, {"ETag": etag})
+
+    def reply(self, status, content_type, data, headers={}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def check():
+    # replays against the stub inside a temporary folder (its own snapshots.db), returns the problems found
+    problems = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}/"
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            session = create_session()
+            first = {"urls": {name: base + name for name in STUB_PAYLOADS}, "endpoints": {}}
+            StubHandler.flaky = {"items"}
+            snapshot = replay_snapshot(session, first, os.path.join(folder, "responses_1"))
+            if [name for name, _ in StubHandler.hits].count("items") != 2:
+                problems.append("a 503 was not retried")
+            for name, payload in STUB_PAYLOADS.items():
+                if store.payload_json(snapshot, name) != payload:
+                    problems.append(f"{name} was not stored as served")
+
+            StubHandler.hits = []
+            second = replay_snapshot(session, {"snapshot": snapshot, **store.manifest(snapshot)}, os.path.join(folder, "responses_2"))
+            if not all(etag for _, etag in StubHandler.hits):
+                problems.append("validators of the previous snapshot were not sent")
+            if [store.payload(second, name) for name in STUB_PAYLOADS] != [store.payload(snapshot, name) for name in STUB_PAYLOADS]:
+                problems.append("payloads answered with 304 were not reused")
+
+            StubHandler.html = {"user"}
+            save_dir = os.path.join(folder, "responses_3")
+            try:
+                replay_snapshot(session, {"urls": first["urls"], "endpoints": {}}, save_dir)
+                problems.append("an html answer was stored as a payload")
+            except ValueError:
+                pass
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+            server.server_close()
+    return problems
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay tools")
+    parser.add_argument("command", choices=["check"], help="check: replay against a local stub api")
+    parser.parse_args()
+    problems = check()
+    for problem in problems:
+        print(problem)
+    print(f"{len(problems)} problems found")
+    sys.exit(1 if problems else 0)
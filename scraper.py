@@ -1,43 +1,86 @@
 import os
+import shutil
 import tempfile
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import NoSuchElementException, TimeoutException, StaleElementReferenceException
+from selenium.common.exceptions import NoSuchElementException, TimeoutException, StaleElementReferenceException, WebDriverException
 from browsermobproxy import Server
 from functools import reduce
 import undetected_chromedriver as uc
 from urllib.parse import urlparse
 import json
 import time
+import base64
+import re
 import exporter
-import tkinter as tk
-import tkinter.ttk as ttk
+import store
+import replay
+import requests
 from concurrent import futures
+from collections import Counter
 import sys
+import atexit
+import threading
 
 TARGET_URL = "https://medicine.sofia.imperial.ac.uk/map/a100/"
 SIGNIN_URL = "https://login.microsoftonline.com/"
+CAPTURE_BACKENDS = ["browsermob", "cdp"]
+CAPTURE_BACKEND = os.environ.get("SOFIA_CAPTURE_BACKEND", "browsermob")
+CDP_RESOURCE_TYPES = ["XHR", "Fetch"]
+# bytes chrome keeps of response bodies for Network.getResponseBody, the defaults can evict a large items payload
+CDP_BUFFER_SIZES = {"maxTotalBufferSize": 256 * 1024 * 1024, "maxResourceBufferSize": 128 * 1024 * 1024}
+REPLAY_MODE = os.environ.get("SOFIA_REPLAY", "0") == "1"
+PERSIST_SESSION = os.environ.get("SOFIA_PERSIST_SESSION", "0") == "1"
+SESSION_MAX_AGE = 12 * 60 * 60 # seconds a saved session is trusted, session cookies have no expiry of their own
+HAR_OPTIONS = {'captureHeaders': True, 'captureContent': True, 'trustAllServers': True}
+PAGE_TIMEOUT = 15
+CAPTURE_DEADLINE = 30 # seconds monitor_traffic waits for the expected endpoints
+QUIET_PERIOD = 3 # seconds without network activity after which optional endpoints are given up on
+POLL_INTERVAL = 0.2
+WRITER_WORKERS = 4
+EXPECTED_ENDPOINTS = exporter.json_name_dict
+# "json" blocks static assets and trackers while the map loads, "full" captures everything
+CAPTURE_PROFILE = os.environ.get("SOFIA_CAPTURE_PROFILE", "json")
+
+def env_list(name, default):
+    # comma-separated values, an empty variable gives an empty list
+    if name not in os.environ:
+        return default
+    return [value.strip() for value in os.environ[name].split(",") if value.strip()]
+
+# chrome Network.setBlockedURLs patterns, "*" matches any run of characters
+CAPTURE_BLOCKED_URLS = env_list("SOFIA_CAPTURE_BLOCK", [
+    "*.png*", "*.jpg*", "*.jpeg*", "*.gif*", "*.svg*", "*.ico*", "*.webp*",
+    "*.woff*", "*.ttf*", "*.otf*", "*.eot*", "*.css*", "*.mp4*", "*.webm*",
+    "*google-analytics.com*", "*googletagmanager.com*", "*fonts.googleapis.com*", "*fonts.gstatic.com*",
+])
+# when not empty, only these hosts are let through the proxy and have their bodies captured
+CAPTURE_ALLOWED_HOSTS = env_list("SOFIA_CAPTURE_ALLOW", [])
+IDLE_TIMEOUT = 10 * 60 # seconds before an unused browser/proxy is shut down
+COOKIE_PARAMS = ["name", "value", "domain", "path", "secure", "httpOnly", "sameSite", "expires"]
 
 if getattr(sys, 'frozen', False):
     base_path = sys._MEIPASS
 else:
     base_path = os.path.abspath(".")
 
+PROFILE_DIR = os.path.join(base_path, "profiles")
+
 class ChromeWithPrefs(uc.Chrome):
-    def __init__(self, *args, options=None, **kwargs):
+    def __init__(self, *args, options=None, user_data_dir=None, **kwargs):
         if options:
-            self._handle_prefs(options)
+            self._handle_prefs(options, user_data_dir)
 
         super().__init__(*args, options=options, **kwargs)
 
-        # remove the user_data_dir when quitting
-        self.keep_user_data_dir = False
+        # remove the user_data_dir when quitting, unless it is a persistent profile
+        self.keep_user_data_dir = user_data_dir is not None
 
     @staticmethod
-    def _handle_prefs(options):
+    def _handle_prefs(options, user_data_dir=None):
         if prefs := options.experimental_options.get("prefs"):
             # turn a (dotted key, value) into a proper nested dict
             def undot_key(key, value):
@@ -52,54 +95,138 @@ class ChromeWithPrefs(uc.Chrome):
                 (undot_key(key, value) for key, value in prefs.items()),
             )
 
-            # create an user_data_dir and add its path to the options
-            user_data_dir = os.path.normpath(tempfile.mkdtemp())
+            # create an user_data_dir (or reuse the persistent one) and add its path to the options
+            if user_data_dir is None:
+                user_data_dir = tempfile.mkdtemp()
+            user_data_dir = os.path.normpath(user_data_dir)
             options.add_argument(f"--user-data-dir={user_data_dir}")
 
             # create the preferences json file in its default directory
             default_dir = os.path.join(user_data_dir, "Default")
-            os.mkdir(default_dir)
+            os.makedirs(default_dir, exist_ok=True)
 
             prefs_file = os.path.join(default_dir, "Preferences")
-            with open(prefs_file, encoding="latin1", mode="w") as f:
-                json.dump(undot_prefs, f)
+            if not os.path.isfile(prefs_file): # chrome owns the file once the profile has been used
+                with open(prefs_file, encoding="latin1", mode="w") as f:
+                    json.dump(undot_prefs, f)
 
             # pylint: disable=protected-access
             # remove the experimental_options to avoid an error
             del options._experimental_options["prefs"]
 
-def startup():
-    print("Startup triggered")
-    server = Server(os.path.join(base_path, "browsermob-proxy-2.1.4/bin/browsermob-proxy"))
-    server.start()
-    proxy = server.create_proxy()
-    proxy.new_har("microsoft_login", options={'captureHeaders': True, 'captureContent': True, 'trustAllServers': True})
+def profile_path(shortcode):
+    return os.path.join(PROFILE_DIR, re.sub(r"[^A-Za-z0-9_-]", "_", shortcode))
+
+def last_profile():
+    try:
+        with open(os.path.join(PROFILE_DIR, "last"), "r") as f:
+            shortcode = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return shortcode or None
+
+def save_session(driver, shortcode):
+    path = profile_path(shortcode)
+    os.makedirs(path, exist_ok=True)
+    cookies = driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+    cookie_file = os.path.join(path, "cookies.json")
+    # the cookie store holds live credentials, keep it private to the user
+    fd = os.open(cookie_file + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"saved": time.time(), "cookies": cookies}, f)
+    os.replace(cookie_file + ".tmp", cookie_file)
+    with open(os.path.join(PROFILE_DIR, "last"), "w") as f:
+        f.write(shortcode)
+    print(f"Session saved for {shortcode}")
+
+def clear_session(shortcode, driver=None):
+    # chrome keeps its own copy of the cookies in the profile (user-data-dir), drop those as well
+    if driver is not None:
+        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+    cookie_file = os.path.join(profile_path(shortcode), "cookies.json")
+    if os.path.isfile(cookie_file):
+        os.remove(cookie_file)
+    if last_profile() == shortcode:
+        os.remove(os.path.join(PROFILE_DIR, "last"))
+    print(f"Session cleared for {shortcode}")
+
+def load_session(driver, shortcode):
+    try:
+        with open(os.path.join(profile_path(shortcode), "cookies.json"), "r") as f:
+            session = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        # nothing to tell the age of the profile's own cookies by, do not trust them
+        driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        return False
+    now = time.time()
+    if now - session["saved"] > SESSION_MAX_AGE:
+        print("Saved session too old")
+        clear_session(shortcode, driver)
+        return False
+    cookies = []
+    for cookie in session["cookies"]:
+        if not cookie.get("session", False) and cookie.get("expires", -1) < now:
+            continue
+        cookies.append({k: v for k, v in cookie.items() if k in COOKIE_PARAMS and not (k == "expires" and v < 0)})
+    if not cookies:
+        return False
+    driver.execute_cdp_cmd("Network.setCookies", {"cookies": cookies})
+    return True
+
+def startup(backend=CAPTURE_BACKEND, shortcode=None):
+    print(f"Startup triggered ({backend})")
+    started = time.time()
+    server = None
+    proxy = None
     chrome_options = Options()
     chrome_options.add_argument("--headless=new")
     chrome_options.add_argument("--disable-dev-shm-usage")
     chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument(f"--proxy-server={proxy.proxy}")
-    chrome_options.add_argument("--ignore-certificate-errors")
+    if backend == "browsermob":
+        server = Server(os.path.join(base_path, "browsermob-proxy-2.1.4/bin/browsermob-proxy"))
+        server.start()
+        proxy = server.create_proxy()
+        proxy.new_har("microsoft_login", options=HAR_OPTIONS)
+        chrome_options.add_argument(f"--proxy-server={proxy.proxy}")
+        chrome_options.add_argument("--ignore-certificate-errors")
+    # Network.* events are read from the performance log: cdp takes the bodies from it, both track completion with it
+    chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
     chrome_options.add_argument("--disable-blink-features=AutomationControlled")
     prefs = {
         "credentials_enable_service": False,
         "profile.password_manager_enabled": False
     }
     chrome_options.add_experimental_option("prefs", prefs)
-    driver = ChromeWithPrefs(options=chrome_options)
+    user_data_dir = profile_path(shortcode) if shortcode else None
+    driver = ChromeWithPrefs(options=chrome_options, user_data_dir=user_data_dir)
+    restored = shortcode is not None and load_session(driver, shortcode)
+    status = open_target(driver)
+    if restored and not status: # sofia or microsoft no longer accept the saved cookies
+        clear_session(shortcode, driver)
+    print(f"Startup completed in {time.time() - started} seconds")
+    return {"server": server, "proxy": proxy, "driver": driver, "status": status, "backend": backend, "started": started, "shortcode": shortcode}
+
+def open_target(driver, timeout=PAGE_TIMEOUT):
+    # sofia either stays on the map or redirects to the microsoft sign-in, wait for one of the two
     driver.get(TARGET_URL)
-    time.sleep(1)
-    status = TARGET_URL in driver.current_url
-    print("Startup completed")
-    return {"server": server, "proxy": proxy, "driver": driver, "status": status}
+    try:
+        WebDriverWait(driver, timeout).until(lambda d: TARGET_URL in d.current_url or d.current_url.startswith(SIGNIN_URL))
+    except TimeoutException:
+        pass
+    return TARGET_URL in driver.current_url
+
+def shutdown(web):
+    if web["server"] is not None:
+        web["server"].stop()
+    web["driver"].quit()
 
-def verify_credentials(driver, message, username, password):
+def verify_credentials(driver, report_number, username, password):
+    # report_number(number) is called with the 2-step verification number to approve on the phone
     driver.get(SIGNIN_URL)
     print("Verifying credentials")
     username = username + "@ic.ac.uk"
     WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.NAME, "loginfmt"))).send_keys(username + Keys.RETURN)
     WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.NAME, "passwd"))).send_keys(password)
-    time.sleep(1)
     try:
         attempts = 0
         while attempts < 2:
@@ -110,20 +237,14 @@ def verify_credentials(driver, message, username, password):
             except StaleElementReferenceException:
                 attempts += 1
         # Wait for the 2-step verification number to appear
-        verification_number = WebDriverWait(driver, 5).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, ".displaySign"))).text
-        while verification_number == "" or verification_number is None:
-            time.sleep(0.1)
-            verification_number = WebDriverWait(driver, 5).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, ".displaySign"))).text
-        number_text = f"2FA number: {verification_number}"
-        message.config(text=number_text, fg="#4d6b0c")
+        verification_number = WebDriverWait(driver, 5, ignored_exceptions=[StaleElementReferenceException]).until(
+            lambda d: d.find_element(By.CSS_SELECTOR, ".displaySign").text or False)
+        report_number(verification_number)
         try:
             attempts = 0
             while attempts < 2:
                 try:
-                    time.sleep(0.5)
-                    auth_sign = driver.find_element(By.CSS_SELECTOR, ".displaySign")
+                    auth_sign = WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.CSS_SELECTOR, ".displaySign")))
                     return WebDriverWait(driver, 60).until(EC.staleness_of(auth_sign))
                 except:
                     attempts += 1
@@ -139,10 +260,167 @@ def clean_path(url):
     cleaned_path = os.path.basename(path)
     return cleaned_path
 
-def monitor_traffic(driver, proxy):
-    driver.get(TARGET_URL)
-    time.sleep(1)
-    WebDriverWait(driver, 5).until(EC.invisibility_of_element_located((By.CSS_SELECTOR, ".Loader")))
+def har_entries(proxy):
+    for entry in proxy.har['log']['entries']:
+        content = entry['response']['content']
+        yield entry['request']['url'], content['mimeType'], content.get('text')
+
+class NetworkTracker:
+    # Follows XHR/fetch requests through the Network.* events of chrome's performance log
+    def __init__(self, driver):
+        self.driver = driver
+        self.reset()
+
+    def reset(self):
+        self.requests = {}
+        self.responses = {}
+        self.done = set()
+        self.landed = Counter()
+        self.uuid = None # curriculum uuid, read from the user endpoint once it landed
+        self.last_activity = time.time()
+        self.stats = {"blocked": 0, "received": 0, "received-json": 0}
+
+    def drain(self):
+        self.driver.get_log("performance") # get_log clears the buffer
+        self.reset()
+
+    def poll(self):
+        for log in self.driver.get_log("performance"):
+            message = json.loads(log["message"])["message"]
+            method = message["method"]
+            params = message.get("params", {})
+            request_id = params.get("requestId")
+            if method == "Network.loadingFinished":
+                self.stats["received"] += int(params.get("encodedDataLength", 0))
+                if request_id in self.responses:
+                    self.stats["received-json"] += int(params.get("encodedDataLength", 0))
+            elif method == "Network.loadingFailed" and params.get("blockedReason"):
+                self.stats["blocked"] += 1
+            if method == "Network.requestWillBeSent":
+                if params.get("type") in CDP_RESOURCE_TYPES and allowed_host(params["request"]["url"]):
+                    self.requests[request_id] = params["request"]["url"]
+            elif request_id not in self.requests:
+                continue
+            elif method == "Network.responseReceived":
+                if "application/json" in params["response"].get("mimeType", ""):
+                    self.responses[request_id] = params["response"]
+            elif method == "Network.loadingFinished":
+                self.done.add(request_id)
+                if request_id in self.responses:
+                    self.landed[clean_path(self.responses[request_id]["url"])] += 1
+            elif method == "Network.loadingFailed":
+                self.done.add(request_id)
+            self.last_activity = time.time()
+
+    def in_flight(self):
+        return [url for request_id, url in self.requests.items() if request_id not in self.done]
+
+    def body(self, request_id):
+        body = self.driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": request_id})
+        text = body["body"]
+        if body.get("base64Encoded"):
+            text = base64.b64decode(text).decode("utf-8")
+        return text
+
+    def find(self, name):
+        for request_id, response in self.responses.items():
+            if request_id in self.done and clean_path(response["url"]) == name:
+                return request_id
+        return None
+
+def allowed_host(url):
+    return not CAPTURE_ALLOWED_HOSTS or urlparse(url).hostname in CAPTURE_ALLOWED_HOSTS
+
+def apply_capture_profile(driver, proxy, profile=CAPTURE_PROFILE):
+    if profile == "full":
+        return
+    # blocked in the browser itself: the requests never reach the proxy or the network
+    driver.execute_cdp_cmd("Network.enable", CDP_BUFFER_SIZES)
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": CAPTURE_BLOCKED_URLS})
+    if proxy is not None and CAPTURE_ALLOWED_HOSTS:
+        hosts = "|".join(re.escape(host) for host in CAPTURE_ALLOWED_HOSTS)
+        proxy.whitelist(f"https?://({hosts})(:\\d+)?/.*", 204)
+
+def clear_capture_profile(driver, proxy, profile=CAPTURE_PROFILE):
+    # the sign-in pages need their stylesheets and third-party hosts back
+    if profile == "full":
+        return
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": []})
+    if proxy is not None and CAPTURE_ALLOWED_HOSTS:
+        requests.delete(f"{proxy.host}/proxy/{proxy.port}/whitelist")
+
+def capture_report(stats):
+    report = f"Capture profile {stats['profile']}: blocked {stats['blocked']} requests, received {stats['received']} bytes ({stats['received-json']} JSON)"
+    if stats["profile"] == "full":
+        return report
+    for response in store.snapshots():
+        manifest = store.manifest(response)
+        if manifest.get("capture", {}).get("profile") == "full":
+            saved = manifest["capture"]["received"] - stats["received"]
+            return report + f", saved {saved} bytes compared to the last full capture"
+    return report
+
+def missing_endpoints(tracker, uuid):
+    missing = {name for name in EXPECTED_ENDPOINTS if not tracker.landed[name]}
+    if uuid is None:
+        missing.add("<curriculum uuid> (items, schemas)")
+    elif tracker.landed[uuid] < 2:
+        missing.add(f"{uuid} ({'items, schemas' if not tracker.landed[uuid] else 'items or schemas'})")
+    return missing
+
+def wait_for_capture(tracker, deadline=CAPTURE_DEADLINE, quiet_period=QUIET_PERIOD, interval=POLL_INTERVAL):
+    # Returns as soon as every expected endpoint landed with nothing in flight, otherwise when the
+    # network stays quiet after the curriculum calls landed, or at the deadline. Returns what is missing.
+    end_time = time.time() + deadline
+    while True:
+        tracker.poll()
+        if tracker.uuid is None and (request_id := tracker.find("user")):
+            try:
+                tracker.uuid = str(json.loads(tracker.body(request_id))["curriculum"])
+            except (WebDriverException, ValueError, KeyError):
+                pass
+        uuid = tracker.uuid
+        missing = missing_endpoints(tracker, uuid)
+        in_flight = tracker.in_flight()
+        if not in_flight:
+            if not missing:
+                return missing
+            if uuid is not None and tracker.landed[uuid] >= 2 and time.time() - tracker.last_activity > quiet_period:
+                return missing
+        if time.time() > end_time:
+            print(f"Capture deadline reached with {len(in_flight)} requests in flight")
+            return missing
+        time.sleep(interval)
+
+def cdp_entries(tracker, lost):
+    # lost collects the expected endpoints whose body could not be read
+    for request_id, response in tracker.responses.items():
+        if request_id not in tracker.done:
+            continue
+        try:
+            text = tracker.body(request_id)
+        except WebDriverException: # body already evicted from Chrome's buffer, or the request failed
+            print(f"No body for {response['url']}")
+            name = clean_path(response["url"])
+            if name in EXPECTED_ENDPOINTS or name == tracker.uuid:
+                lost.append(name)
+            continue
+        yield response["url"], response["mimeType"], text
+
+def monitor_traffic(driver, proxy, backend=CAPTURE_BACKEND, started=None, deadline=CAPTURE_DEADLINE):
+    tracker = NetworkTracker(driver)
+    if backend == "cdp": # before the map loads, the buffer sizes only apply to later requests
+        driver.execute_cdp_cmd("Network.enable", CDP_BUFFER_SIZES)
+    tracker.drain() # drop the login traffic
+    apply_capture_profile(driver, proxy)
+    try:
+        driver.get(TARGET_URL)
+        missing = wait_for_capture(tracker, deadline)
+    finally:
+        clear_capture_profile(driver, proxy)
+    stats = {"profile": CAPTURE_PROFILE, **tracker.stats}
+    if missing:
+        print(f"Capture incomplete, missing endpoints: {', '.join(sorted(missing))}")
     # Save JSON responses from XHR/fetch requests
     dir_name = f"responses_{int(round(time.time()))}"
     save_dir = os.path.join(base_path, dir_name)
@@ -151,184 +429,176 @@ def monitor_traffic(driver, proxy):
     json_bool = True
     start_saving = "user"
     start_time = time.time()
-    for entry in proxy.har['log']['entries']:
-        request = entry['request']
-        response = entry['response']
-        content = response['content']
-        name = clean_path(request['url'])
-        if json_bool:
-            if "application/json" in response['content']['mimeType']:
-                if not (start_saving == True or name == start_saving):
-                    continue
-                else:
-                    start_saving = True
-                if 'text' in content:
-                    if not len(content['text']):
+    first_file = []
+    urls = {}
+    jobs = []
+    stamp = time.time_ns() # file prefix, keeps the capture order when sorted
+    lost = []
+    entries = cdp_entries(tracker, lost) if backend == "cdp" else har_entries(proxy)
+    # bodies are stored as received, normalise_snapshot only parses the few it has to
+    with futures.ThreadPoolExecutor(max_workers=WRITER_WORKERS, thread_name_prefix="writer") as writers:
+        def write(file_path, text):
+            jobs.append(writers.submit(exporter.write_atomic, file_path, text.encode("utf-8")))
+            if len(jobs) == 1:
+                jobs[0].add_done_callback(lambda job: first_file.append(time.time()))
+
+        for index, (url, mime_type, text) in enumerate(entries):
+            name = clean_path(url)
+            if json_bool:
+                if "application/json" in mime_type:
+                    if not (start_saving == True or name == start_saving):
+                        continue
+                    else:
+                        start_saving = True
+                    if text is not None:
+                        if not len(text):
+                            continue
+                        file_path = os.path.join(save_dir, f"{stamp + index}_{name}.json")
+                        write(file_path, text)
+                        urls[os.path.basename(file_path)] = url
+            else:
+                if text is not None:
+                    if not len(text):
                         continue
-                    file_path = os.path.join(save_dir, f"{int(round(time.time_ns()))}_{name}.json")
-                    with open(file_path, "w") as f:
-                        json_obj = json.loads(content['text'])
-                        json.dump(json_obj, f, indent=4)
-        else:
-            if 'text' in content:
-                if not len(content['text']):
-                    continue
-                file_name = f"{name}_response_{int(round(time.time() * 1000))}.txt"
-                file_path = os.path.join(save_dir, file_name)
-                with open(file_path, "w") as f:
-                    f.write(content['text'])
+                    file_name = f"{name}_response_{stamp + index}.txt"
+                    file_path = os.path.join(save_dir, file_name)
+                    write(file_path, text)
+    for job in jobs:
+        job.result()
+    if lost:
+        exporter.set_aside(save_dir)
+        raise ValueError(f"Chrome no longer held the body of {', '.join(lost)}, see CDP_BUFFER_SIZES")
+    exporter.normalise_snapshot(save_dir, urls=urls, extra={"capture": stats})
+    print(capture_report(stats))
+    try:
+        snapshot = exporter.store_snapshot(save_dir)
+    except ValueError: # e.g. the user or curriculum endpoints never landed
+        exporter.set_aside(save_dir)
+        raise
     print(f"Elapsed Scraping Time: {time.time() - start_time} seconds")
+    if started is not None and first_file:
+        print(f"Startup to first file ({backend}): {first_file[0] - started} seconds")
+    return {"snapshot": snapshot, "missing": sorted(missing)}
+
+def replay_traffic(driver, proxy, backend=CAPTURE_BACKEND, started=None):
+    # Skips rendering the map: fetches the endpoints of the last captured snapshot directly
+    previous = replay.latest_replayable()
+    if previous is None:
+        print("No snapshot with recorded urls, falling back to page capture")
+        return monitor_traffic(driver, proxy, backend, started)
+    session = replay.session_from_driver(driver, TARGET_URL)
+    save_dir = os.path.join(base_path, f"responses_{int(round(time.time()))}")
+    try:
+        snapshot = replay.replay_snapshot(session, previous, save_dir)
+    except (requests.RequestException, ValueError) as exc: # session not accepted by the api, or not json
+        print(f"Replay failed ({exc}), falling back to page capture")
+        shutil.rmtree(save_dir, ignore_errors=True)
+        return monitor_traffic(driver, proxy, backend, started)
+    return {"snapshot": snapshot, "missing": sorted(name for name in EXPECTED_ENDPOINTS if name not in previous["urls"])}
+
+class ScraperSession:
+    # One browser (and proxy) per application run, shared by every LoginWindow
+    def __init__(self, backend=CAPTURE_BACKEND, idle_timeout=IDLE_TIMEOUT):
+        self.backend = backend
+        self.idle_timeout = idle_timeout
+        self.web = None
+        self.lock = threading.RLock()
+        self.idle_timer = None
+        self.holds = 0
+        # a single worker: the driver is not thread safe, jobs run one after another
+        self.executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="scraper")
+
+    def submit(self, fn, *args):
+        return self.executor.submit(self._run, fn, *args)
+
+    def _run(self, fn, *args):
+        with self.lock:
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+            try:
+                return fn(*args)
+            finally:
+                self.start_idle_timer()
+
+    def start_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        self.idle_timer = threading.Timer(self.idle_timeout, self.idle_stop)
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
+
+    def hold(self):
+        # a login window is waiting on the user between jobs, the browser must outlive the idle timeout
+        self.holds += 1
+
+    def release(self):
+        self.holds -= 1
+        if not self.holds:
+            self.start_idle_timer()
+
+    def healthy(self):
+        if self.web is None:
+            return False
+        if self.web["server"] is not None and self.web["server"].process.poll() is not None:
+            return False
+        try:
+            self.web["driver"].current_url
+        except WebDriverException:
+            return False
+        return True
 
-class LoginWindow(tk.Toplevel):
-    def __init__(self, root):
-        tk.Toplevel.__init__(self, root)
-        self.executor = futures.ThreadPoolExecutor(max_workers=2)
-        self.webscraper_thread = self.executor.submit(startup)
-        self.webscraper_thread.add_done_callback(self.startup_callback)
-        self.title("Sign In")
-        self.geometry("400x350")
-        self.attributes('-topmost', True)
-        self.grid_columnconfigure(0, weight=1)
-        self.grid_rowconfigure(0, weight=1)
-        self.root = root
-        self.username_var = tk.StringVar()
-        self.password_var = tk.StringVar()
-        self.logged_in = False
-        self.verifying = False
-        self.protocol("WM_DELETE_WINDOW", self.force_end)
-        self.transient(root)
-        self.grab_set()
-
-    @classmethod
-    def start_login(cls, root, callback, mainwindow_callback):
-        self = cls(root)
-
-        self.callback = callback
-        self.mainwindow_callback = mainwindow_callback
-        self.btn_clicked = tk.IntVar()
-        self.create_widgets()
-        self.await_login()
-
-    def create_widgets(self):
-        self.frame = ttk.Frame(self, padding="10 10 10 10")
-        self.frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), padx=10, pady=10)
-        self.frame.columnconfigure(0, weight=1)
-        self.frame.columnconfigure(1, weight=3)
-        self.frame.rowconfigure(2, weight=1)
-
-        label_username = tk.Label(self.frame, text="Shortcode:")
-        label_username.grid(column=0, row=0, padx=5, pady=5, sticky="NSW")
-        self.entry_username = tk.Entry(self.frame, textvariable=self.username_var)
-        self.entry_username.grid(column=1, row=0, padx=5, pady=5, sticky="NSWE")
-
-        label_pw = tk.Label(self.frame, text="Password:")
-        label_pw.grid(column=0, row=1, padx=5, pady=5, sticky="NSW")
-        self.entry_password = tk.Entry(self.frame, show="*", textvariable=self.password_var)
-        self.entry_password.grid(column=1, row=1, padx=5, pady=5, sticky="NSWE")
-
-        self.message = tk.Label(self.frame, text="", fg="#0c1069", font=("Helvetica", 12, "bold"), height=10)
-        self.message.grid(column=0, row=2, columnspan=2, sticky="NWE")
-
-        self.btn_login = tk.Button(self.frame, text="Login", command=lambda: self.btn_clicked.set(1))
-        self.btn_login.grid(column=0, row=3, columnspan=2)
-
-    def create_loading_widgets(self):
-        self.frame = ttk.Frame(self, padding="10 10 10 10")
-        self.frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), padx=10, pady=10)
-        self.frame.columnconfigure(0, weight=1)
-        self.frame.rowconfigure(1, weight=1)
-
-        self.loading_bar = ttk.Progressbar(self.frame, mode="indeterminate", orient="horizontal")
-        self.loading_bar.grid(column=0, row=0, padx=5, pady=5, sticky="SWE")
-        self.loading_bar.start(100)
-
-        self.message = tk.Label(self.frame, text="Loading...", fg="#0c1069", font=("Helvetica", 12, "bold"))
-        self.message.grid(column=0, row=1, sticky="NWE")
-        
-    def on_login(self):
-        if self.username_var.get() and self.password_var.get():
-            self.message.config(text="Processing", fg="#0c1069")
-            if self.webscraper_thread.done() and self.webscraper_thread.exception() is None:
-                if self.logged_in:
-                    self.after_login()
-                    return
-                self.webscraper_thread = self.executor.submit(verify_credentials, self.web["driver"], self.message, self.username_var.get(), self.password_var.get())
-                self.webscraper_thread.add_done_callback(self.verification_callback)
-                return
-            print("Startup of scraper not done or called an exception")
-            return
-        self.message.config(text="Please fill in both fields.", foreground="#e62e09")
-        if not self.message.winfo_exists():
-            self.message.pack()
-
-    def await_login(self):
-        self.btn_login.wait_variable(self.btn_clicked)
-        if self.verifying:
-            self.await_login()
-            return
-        self.on_login()
-        if self.logged_in:
-            print("Successful Sign-in: Scrapping has started")
-            self.after_login()
+    def ensure_started(self, shortcode=None):
+        if self.web is not None and not self.healthy():
+            print("Scraper session unhealthy, restarting")
+            self.stop()
+        if self.web is None:
+            self.web = startup(self.backend, shortcode)
+            return self.web
+        print("Reusing scraper session")
+        driver = self.web["driver"]
+        self.web["started"] = time.time()
+        self.web["status"] = open_target(driver)
+        return self.web
+
+    def new_capture(self, ref):
+        if self.web["proxy"] is not None:
+            self.web["proxy"].new_har(ref, options=HAR_OPTIONS)
+
+    def capture(self, fetch):
+        self.new_capture(f"capture_{int(time.time())}")
+        web = self.web
+        return fetch(web["driver"], web["proxy"], web["backend"], web["started"])
+
+    def stop(self):
+        if self.web is None:
             return
-        self.await_login()
-    
-    def after_login(self):
-        self.webscraper_thread = self.executor.submit(monitor_traffic, self.web["driver"], self.web["proxy"])
-        self.webscraper_thread.add_done_callback(self.scraping_callback)
-        self.frame.destroy()
-        self.create_loading_widgets()
-
-    def startup_callback(self, future):
-        print("Startup callback triggered")
-        self.web = future.result()
-        self.logged_in = bool(self.web["status"])
-
-    def verification_callback(self, future):
-        result = future.result()
-        if result:
-            self.after_login()
-        else:
-            self.message.config(text="Verification failed", fg="#e62e09")
-
-    def scraping_callback(self, future):
-        if future.done():
-            try:
-                self.end()
-            except Exception as exc:
-                print("Scraping had an exception")
-                print(exc)
-                print(future.exception())
-                self.callback()
-                self.mainwindow_callback()
-
-    def force_end(self):
         try:
-            self.destroy()
-            self.update()
-            self.callback()
-            self.mainwindow_callback()
-            self.web["server"].stop()
-            self.web["driver"].quit()
-            self.executor.shutdown(wait=False)
-        except:
-            self.executor.shutdown(wait=False)
-            print("Force ended")
-
-    def end(self):
-        responses = exporter.get_responses()
-        exporter.get_files(responses)
-        self.web["server"].stop()
-        self.web["driver"].quit()
+            shutdown(self.web)
+        except Exception as exc:
+            print(f"Error stopping scraper session: {exc}")
+        self.web = None
         print("Server and driver quitted")
-        print(self.webscraper_thread.done())
-        self.executor.shutdown(wait=False)
-        # When set to true, thread will not be able to join to main thread due to tkiners mainloop running.
-        # potential solution: with statement for proper cleanup
-        # for now, the threadpool will permanently be running in the background even after application closes lol
-        print("Executor ended")
-        self.destroy()
-        self.update()
-        self.callback()
-        self.mainwindow_callback()
-        print("Login Window destroyed")
\ No newline at end of file
+
+    def idle_stop(self):
+        with self.lock:
+            # still held, or a newer timer was started while this one waited for the lock
+            if self.holds or threading.current_thread() is not self.idle_timer:
+                return
+            print("Scraper session idle, shutting down")
+            self.stop()
+
+    def close(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            self.stop()
+
+scraper_session = None
+
+def get_session():
+    global scraper_session
+    if scraper_session is None:
+        scraper_session = ScraperSession()
+        atexit.register(scraper_session.close)
+    return scraper_session
@@ -1,7 +1,8 @@
 import json
 import os
 import time
-from exporter import get_responses, get_files
+from exporter import get_responses
+import store
 
 COMMON_VALUES = ["code"]
 
@@ -36,22 +37,17 @@ def common_search_closure(struct, path, depth):
     depth[v].add(str(struct))
     return depth
 
-def create_common_files(save_dir, response, start_with="responses_"):
-    folder_path = start_with+response
-    for f in os.listdir(folder_path):
-        path = os.path.join(folder_path, f)
-        filename = os.fsdecode(f)
-        if filename.endswith(".json"):
-            with open(path, "r") as file:
-                print(f"------ START File: {f} ------")
-                json_d = json.load(file)
-                data = dfs(json_d)
-                for k in data:
-                    if isinstance(data[k], set):
-                        data[k] = list(data[k])
-                new_path = os.path.join(save_dir, f"{filename[:-5]}.json")
-                with open(new_path, "w") as new_file:
-                    json.dump(data, new_file, indent=4)
+def create_common_files(save_dir, response):
+    for endpoint, payload in store.payloads(response):
+        print(f"------ START File: {endpoint} ------")
+        json_d = json.loads(payload)
+        data = dfs(json_d)
+        for k in data:
+            if isinstance(data[k], set):
+                data[k] = list(data[k])
+        new_path = os.path.join(save_dir, f"{endpoint}.json")
+        with open(new_path, "w") as new_file:
+            json.dump(data, new_file, indent=4)
         print(f"------ END File ------")
 
 def common_values(save_dir, response, start_with="COMMON_", separator="-"):
@@ -79,7 +75,6 @@ def common_values(save_dir, response, start_with="COMMON_", separator="-"):
 
 if __name__ == "__main__":
     responses = get_responses()
-    path_dict = get_files(responses)
     for i in responses:
         dir_name = f"COMMON_{i}"
         save_dir = os.path.join('.', dir_name)
@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import hashlib
+import sqlite3
+import argparse
+import threading
+
+STORE_PATH = "snapshots.db"
+MMAP_SIZE = 256 * 1024 * 1024 # item reads come straight from the mapped file
+SCHEMA_VERSION = 1
+
+# payloads are stored once per distinct content: blobs are keyed by the hash of the canonical
+# json (sorted keys, no whitespace) and snapshots only reference them. items indexes each item of
+# an items blob by id and uuid, with the byte offset and length of its json inside the blob, and
+# trees holds a serialised year tree per items blob and curriculum step uuid. The per-item tables
+# refer to their blob by its integer id, a hash in every row of every index would outweigh the items
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot TEXT PRIMARY KEY,
+    uuid_curriculum TEXT,
+    manifest TEXT NOT NULL,
+    manifest_checksum TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS payloads (
+    snapshot TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (snapshot, endpoint)
+);
+CREATE INDEX IF NOT EXISTS payloads_hash ON payloads (hash);
+CREATE TABLE IF NOT EXISTS items (
+    blob INTEGER NOT NULL,
+    id TEXT NOT NULL,
+    uuid TEXT,
+    type TEXT,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (blob, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS items_uuid ON items (blob, uuid);
+CREATE INDEX IF NOT EXISTS items_type ON items (blob, type);
+CREATE TABLE IF NOT EXISTS item_children (
+    blob INTEGER NOT NULL,
+    parent TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    child TEXT NOT NULL,
+    PRIMARY KEY (blob, parent, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS item_parents ON item_children (blob, child);
+CREATE TABLE IF NOT EXISTS trees (
+    blob INTEGER NOT NULL,
+    uuid TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (blob, uuid)
+) WITHOUT ROWID;
+"""
+
+local = threading.local()
+
+def connect(path=STORE_PATH):
+    # one connection per thread, the scraper ingests while the ui reads
+    connections = getattr(local, "connections", None)
+    if connections is None:
+        connections = local.connections = {}
+    path = os.path.abspath(path)
+    if path not in connections:
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0: # new store, created in one transaction so an interrupted start leaves it empty
+            conn.executescript(f"BEGIN; {SCHEMA} PRAGMA user_version={SCHEMA_VERSION}; COMMIT;")
+        elif version != SCHEMA_VERSION:
+            conn.close()
+            raise ValueError(f"{path} has schema version {version}, this version of the app reads {SCHEMA_VERSION}")
+        connections[path] = conn
+    return connections[path]
+
+def checksum(data):
+    return hashlib.sha256(data).hexdigest()
+
+def canonical_hash(obj):
+    return checksum(json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+
+def store_payload(conn, snapshot, endpoint, data):
+    obj = json.loads(data)
+    digest = canonical_hash(obj)
+    compact = json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    new = conn.execute("INSERT OR IGNORE INTO blobs (hash, data) VALUES (?, ?)", (digest, compact)).rowcount
+    if endpoint == "items":
+        blob = conn.execute("SELECT id FROM blobs WHERE hash = ?", (digest,)).fetchone()[0]
+        if not conn.execute("SELECT 1 FROM items WHERE blob = ? LIMIT 1", (blob,)).fetchone():
+            if new:
+                index_items(conn, blob, compact, obj)
+            else: # same content stored earlier, maybe with the keys in another order, offsets must match that copy
+                index_items(conn, blob, conn.execute("SELECT data FROM blobs WHERE id = ?", (blob,)).fetchone()[0])
+    conn.execute("INSERT OR REPLACE INTO payloads VALUES (?, ?, ?)", (snapshot, endpoint, digest))
+    return new
+
+def ingest_snapshot(folder_path, snapshot, manifest, path=STORE_PATH):
+    # Copies a normalised responses_<epoch> folder into the store, then removes the files it copied
+    conn = connect(path)
+    payloads = []
+    for endpoint, file in manifest["endpoints"].items():
+        with open(os.path.join(folder_path, file), "rb") as f:
+            data = f.read()
+        if manifest["checksums"].get(file, checksum(data)) != checksum(data):
+            raise ValueError(f"Checksum mismatch for {file} in {folder_path}")
+        payloads.append((endpoint, data))
+    manifest_text = json.dumps(manifest, sort_keys=True)
+    with conn:
+        clear_snapshot(conn, snapshot)
+        conn.execute("INSERT INTO snapshots VALUES (?, ?, ?, ?)",
+                     (snapshot, manifest["uuid-curriculum"], manifest_text, checksum(manifest_text.encode("utf-8"))))
+        new = sum(store_payload(conn, snapshot, endpoint, data) for endpoint, data in payloads)
+    for file in set(manifest["endpoints"].values()) | {"manifest.json", "items-cache.json"}:
+        if os.path.isfile(os.path.join(folder_path, file)):
+            os.remove(os.path.join(folder_path, file))
+    if not os.listdir(folder_path):
+        os.rmdir(folder_path)
+    print(f"Snapshot {snapshot} stored in {path} ({new} of {len(payloads)} payloads new)")
+
+def item_spans(data, items):
+    # byte offset and length of every item's json inside the compact blob, found by
+    # serialising each item the same way the blob was written
+    position = 1 # past the opening brace
+    for k, v in items.items():
+        position += len(json.dumps(k, ensure_ascii=False).encode("utf-8")) + 1 # "key":
+        length = len(json.dumps(v, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+        yield k, v, position, length
+        position += length + 1 # the value and the comma or closing brace after it
+    if items and position != len(data):
+        raise ValueError("items blob is not in compact form")
+
+def index_items(conn, blob, data, items=None):
+    if items is None:
+        items = json.loads(data)
+    conn.executemany("INSERT INTO items VALUES (?, ?, ?, ?, ?, ?)", [
+        (blob, k, v.get("uuid"), v.get("type"), offset, length)
+        for k, v, offset, length in item_spans(data, items)])
+    conn.executemany("INSERT INTO item_children VALUES (?, ?, ?, ?)", (
+        (blob, k, position, child)
+        for k, v in items.items() for position, child in enumerate(v.get("children") or ())))
+
+def clear_snapshot(conn, snapshot):
+    # blobs are left for gc, another snapshot may still reference them
+    for table in ("snapshots", "payloads"):
+        conn.execute(f"DELETE FROM {table} WHERE snapshot = ?", (snapshot,))
+
+def delete_snapshot(snapshot, path=STORE_PATH):
+    conn = connect(path)
+    with conn:
+        clear_snapshot(conn, snapshot)
+
+def snapshots(path=STORE_PATH, endpoints=()):
+    # endpoints: only list snapshots that hold a payload for every one of them
+    rows = connect(path).execute(f"""
+        SELECT snapshot FROM snapshots s WHERE ? = (
+            SELECT COUNT(*) FROM payloads p WHERE p.snapshot = s.snapshot AND p.endpoint IN ({",".join("?" * len(endpoints))})
+        ) ORDER BY snapshot DESC
+    """, (len(endpoints), *endpoints))
+    return [row[0] for row in rows]
+
+def manifest(snapshot, path=STORE_PATH):
+    row = connect(path).execute("SELECT manifest FROM snapshots WHERE snapshot = ?", (snapshot,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def manifest_checksum(snapshot, path=STORE_PATH):
+    row = connect(path).execute("SELECT manifest_checksum FROM snapshots WHERE snapshot = ?", (snapshot,)).fetchone()
+    return row[0] if row else None
+
+def payload(snapshot, endpoint, path=STORE_PATH):
+    row = connect(path).execute("""
+        SELECT b.data FROM payloads p JOIN blobs b ON b.hash = p.hash WHERE p.snapshot = ? AND p.endpoint = ?
+    """, (snapshot, endpoint)).fetchone()
+    return row[0] if row else None
+
+def payload_json(snapshot, endpoint, path=STORE_PATH):
+    data = payload(snapshot, endpoint, path)
+    return json.loads(data) if data is not None else None
+
+def payloads(snapshot, path=STORE_PATH):
+    return connect(path).execute("""
+        SELECT p.endpoint, b.data FROM payloads p JOIN blobs b ON b.hash = p.hash WHERE p.snapshot = ? ORDER BY p.endpoint
+    """, (snapshot,))
+
+def items_blob(snapshot, path=STORE_PATH):
+    # integer id of the snapshot's items blob, the key of its rows in items, item_children and trees
+    row = connect(path).execute("""
+        SELECT b.id FROM payloads p JOIN blobs b ON b.hash = p.hash WHERE p.snapshot = ? AND p.endpoint = 'items'
+    """, (snapshot,)).fetchone()
+    return row[0] if row else None
+
+def item_id(snapshot, uuid, path=STORE_PATH):
+    row = connect(path).execute("SELECT id FROM items WHERE blob = ? AND uuid = ?", (items_blob(snapshot, path), uuid)).fetchone()
+    return row[0] if row else None
+
+def read_spans(conn, blob, spans):
+    # spans: (offset, length) inside one blob, read without loading the whole payload
+    if not hasattr(conn, "blobopen"): # python < 3.11
+        for offset, length in spans:
+            yield conn.execute("SELECT substr(data, ?, ?) FROM blobs WHERE id = ?", (offset + 1, length, blob)).fetchone()[0]
+        return
+    with conn.blobopen("blobs", "data", blob, readonly=True) as reader:
+        for offset, length in spans:
+            reader.seek(offset)
+            yield reader.read(length)
+
+def subtree_spans(snapshot, root_id, path=STORE_PATH):
+    # (id, offset, length) of every item below and including root_id
+    conn = connect(path)
+    blob = items_blob(snapshot, path)
+    return conn.execute("""
+        WITH RECURSIVE sub(id) AS (
+            SELECT ?
+            UNION
+            SELECT c.child FROM item_children c JOIN sub ON c.parent = sub.id WHERE c.blob = ?
+        )
+        SELECT i.id, i.offset, i.length FROM items i JOIN sub ON i.id = sub.id WHERE i.blob = ?
+    """, (root_id, blob, blob)).fetchall()
+
+def read_items(snapshot, offsets, lengths, path=STORE_PATH):
+    # the items at these spans of the snapshot's items blob, in order. The spans are joined
+    # into one json array so they are parsed in a single call
+    conn = connect(path)
+    return json.loads(b"[" + b",".join(read_spans(conn, items_blob(snapshot, path), zip(offsets, lengths))) + b"]")
+
+def tree(blob, uuid, path=STORE_PATH):
+    row = connect(path).execute("SELECT data FROM trees WHERE blob = ? AND uuid = ?", (blob, uuid)).fetchone()
+    return row[0] if row else None
+
+def tree_version(blob, uuid, path=STORE_PATH):
+    row = connect(path).execute("SELECT version FROM trees WHERE blob = ? AND uuid = ?", (blob, uuid)).fetchone()
+    return row[0] if row else None
+
+def save_tree(blob, uuid, version, data, path=STORE_PATH):
+    conn = connect(path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO trees VALUES (?, ?, ?, ?)", (blob, uuid, version, data))
+
+def verify(path=STORE_PATH):
+    conn = connect(path)
+    problems = []
+    for digest, data in conn.execute("SELECT hash, data FROM blobs"):
+        if canonical_hash(json.loads(data)) != digest:
+            problems.append(f"blob {digest} does not match its hash")
+    for snapshot, endpoint, digest in conn.execute("""
+        SELECT p.snapshot, p.endpoint, p.hash FROM payloads p LEFT JOIN blobs b ON b.hash = p.hash WHERE b.hash IS NULL
+    """):
+        problems.append(f"snapshot {snapshot} endpoint {endpoint} references missing blob {digest}")
+    for snapshot, text, digest in conn.execute("SELECT snapshot, manifest, manifest_checksum FROM snapshots"):
+        if checksum(text.encode("utf-8")) != digest:
+            problems.append(f"snapshot {snapshot} manifest does not match its checksum")
+    for (digest,) in conn.execute("""
+        SELECT DISTINCT p.hash FROM payloads p WHERE p.endpoint = 'items'
+        AND NOT EXISTS (SELECT 1 FROM items i JOIN blobs b ON b.id = i.blob WHERE b.hash = p.hash)
+    """):
+        problems.append(f"items blob {digest} is not indexed")
+    for blob, digest, data in conn.execute("SELECT id, hash, data FROM blobs WHERE id IN (SELECT DISTINCT blob FROM items)"):
+        for id, offset, length in conn.execute("SELECT id, offset, length FROM items WHERE blob = ?", (blob,)):
+            try:
+                json.loads(data[offset:offset + length])
+            except ValueError:
+                problems.append(f"items blob {digest} has a bad offset for item {id}")
+                break
+    return problems
+
+def gc(path=STORE_PATH):
+    conn = connect(path)
+    with conn:
+        unreferenced = "SELECT id FROM blobs WHERE hash NOT IN (SELECT hash FROM payloads)"
+        conn.execute(f"DELETE FROM items WHERE blob IN ({unreferenced})")
+        conn.execute(f"DELETE FROM item_children WHERE blob IN ({unreferenced})")
+        conn.execute(f"DELETE FROM trees WHERE blob IN ({unreferenced})")
+        removed = conn.execute(f"DELETE FROM blobs WHERE id IN ({unreferenced})").rowcount
+    conn.execute("VACUUM")
+    return removed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the snapshot store")
+    parser.add_argument("command", choices=["verify", "gc", "delete"])
+    parser.add_argument("snapshot", nargs="?", help="snapshot to delete")
+    parser.add_argument("--store", default=STORE_PATH)
+    args = parser.parse_args()
+    match args.command:
+        case "verify":
+            problems = verify(args.store)
+            for problem in problems:
+                print(problem)
+            print(f"{len(problems)} problems found")
+            sys.exit(1 if problems else 0)
+        case "gc":
+            print(f"Removed {gc(args.store)} unreferenced blobs")
+        case "delete":
+            if args.snapshot is None:
+                parser.error("delete needs a snapshot")
+            delete_snapshot(args.snapshot, args.store)
+            print(f"Deleted snapshot {args.snapshot}, run gc to reclaim its blobs")
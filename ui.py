@@ -3,10 +3,11 @@ from tkinter import ttk
 from tkinter import filedialog
 from PIL import Image, ImageTk
 from exporter import *
+from curriculum import CheckState, CHECKED, STATES
 from scraper import *
-from anytree import Node, find_by_attr, RenderTree
-import re
 import asyncio
+import queue
+from concurrent import futures
 
 MIN_HEIGHT = 700
 MIN_WIDTH = 400
@@ -14,6 +15,10 @@ START_HEIGHT = 1000
 START_WIDTH = 800
 EXPORT_WINDOW_HEIGHT = 500
 EXPORT_WINDOW_WIDTH = 600
+PLACEHOLDER = "::placeholder"
+TREE_DEBOUNCE = 50 # ms to wait for the other traces of the same change before loading a tree
+TREE_POLL = 50 # ms between checks for a loaded tree
+EXPORT_ALL = "all" # every file type from one export
 
 if getattr(sys, 'frozen', False):
     base_path = sys._MEIPASS
@@ -34,51 +39,32 @@ class CheckboxTreeview(ttk.Treeview):
         self.bind("<Return>", self.check_items, False)
         self.bind("<<TreeviewSelect>>", self.on_select)
         self.bind("<<TreeviewOpen>>", self.on_open)
+        self.bind("<<TreeviewClose>>", self.on_close)
         self.check_hidden = tk.BooleanVar(value=False)
         self.prop_node_id = tk.StringVar()
         self.responses = get_responses()
         self.time_responses = [epoch_to_datetime(float(x)) for x in self.responses]
         self.loop = asyncio.get_event_loop()
+        self.loader = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="tree")
+        self.loaded_trees = queue.Queue()
+        self.load_job = None
+        self.pending_load = None
+        self.polling = False
+        self.generation = 0
+        self.requested = None
 
     def get_checked(self):
-        checked_nodes = self.tag_has("checked")
-        tristate_nodes = self.tag_has("tristate")
-        if not checked_nodes:
+        # export starts at the topmost selected node above the first checked one,
+        # extract_paths then follows the check states to prune the rest
+        tree = self.node.tree
+        states = self.state.states
+        index = next((i for i in tree.preorder() if states[i] == CHECKED), None)
+        if index is None:
             return None
-        nodes = {}
-        print(checked_nodes)
-        print(tristate_nodes)
-
-        def add_node(node):
-            if node.name not in nodes:
-                nodes[node.name] = Node(name=node.name, obj=node.obj)
-            parent = node.parent
-            if parent:
-                if parent.name in checked_nodes or parent.name in tristate_nodes:
-                    if parent.name not in nodes:
-                        if parent.is_root:
-                            nodes[parent.name] = Node(name=parent.name, obj=parent.obj)
-                        else:
-                            add_node(parent)
-                    nodes[node.name].parent = nodes[parent.name]
-
-        for item in checked_nodes:
-            node = find_by_attr(self.node, item)
-            if node:
-                add_node(node)
-
-        for node in nodes.values():
-            node.children = tuple(child for child in node.children if child.name in checked_nodes or child.name in tristate_nodes)
-
-        root_nodes = [node for node in nodes.values() if node.is_root]
-        if not root_nodes:
-            return None
-        root_node = root_nodes[0]
-        title = root_node.obj["title"]
-        print(f"Rootnode title: {title}")
-        for pre, fill, node in RenderTree(root_node):
-            print("%s%s" % (pre, node.name))
-        print(nodes.keys())
+        while tree.parents[index] >= 0 and states[tree.parents[index]]:
+            index = tree.parents[index]
+        root_node = tree.node(index)
+        print(f"Rootnode title: {root_node.title}")
         return root_node
 
     def image_config(self, file_path, width, height):
@@ -100,71 +86,112 @@ class CheckboxTreeview(ttk.Treeview):
         if int(curriculum) < 0 or response == "":
             print("Empty")
             return
-        if response != "":
-            dt = str(datetime_to_epoch(response))
-            print(f"Changed to {dt}, {curriculum}")
-            self.node = get_tree([dt], curriculum)
-            if len(self.get_children()) > 0:
-                self.delete(*self.get_children())
-            self.insert_tree("", self.node)
-            self.item(self.node.name, open=True)
-
-    def insert_tree(self, parent, node):
-        new_node = self.insert(parent, "end", iid=node.name, text=node.obj["title"], values=(len(node.children)))
-        for c in node.children:
-            self.insert_tree(node.name, c)
-    
+        # one change fires several traces, only the last one within TREE_DEBOUNCE loads
+        if self.pending_load is not None:
+            self.after_cancel(self.pending_load)
+        self.pending_load = self.after(TREE_DEBOUNCE, self.load_tree, response, curriculum)
+
+    def load_tree(self, response, curriculum):
+        self.pending_load = None
+        dt = str(datetime_to_epoch(response))
+        if (dt, curriculum) == self.requested:
+            return
+        self.requested = (dt, curriculum)
+        print(f"Changed to {dt}, {curriculum}")
+        self.generation += 1
+        if self.load_job is not None:
+            self.load_job.cancel() # only succeeds if the previous load has not started yet
+        self.load_job = self.loader.submit(self.build_tree, self.generation, dt, curriculum)
+        if not self.polling:
+            self.polling = True
+            self.after(TREE_POLL, self.poll_trees)
+
+    def build_tree(self, generation, dt, curriculum):
+        # runs on the loader thread, results go back to Tk through the queue
+        if generation != self.generation:
+            return
+        try:
+            self.loaded_trees.put((generation, get_tree([dt], curriculum)))
+        except Exception as exc:
+            print(f"Loading curriculum {curriculum} of {dt} failed: {exc}")
+            self.loaded_trees.put((generation, None))
+
+    def poll_trees(self):
+        while not self.loaded_trees.empty():
+            generation, node = self.loaded_trees.get()
+            if generation != self.generation: # older loads were superseded
+                continue
+            if node is None:
+                self.requested = None # failed, selecting the same year again retries it
+            else:
+                self.show_tree(node)
+        if self.load_job.done() and self.loaded_trees.empty():
+            self.polling = False
+        else:
+            self.after(TREE_POLL, self.poll_trees)
+
+    def show_tree(self, node):
+        self.node = node
+        self.state = CheckState(self.node.tree)
+        self.populated = set()
+        self.positions = {} # iid -> tree position of every inserted row
+        self.opened = {self.node.index}
+        if len(self.get_children()) > 0:
+            self.delete(*self.get_children())
+        self.insert_node("", self.node)
+        self.populate(self.node.index)
+        self.item(self.node.name, open=True)
+
+    def insert_node(self, parent, node):
+        # children are only inserted once the row is opened, a placeholder keeps the expand arrow
+        self.positions[node.name] = node.index
+        self.insert(parent, "end", iid=node.name, text=node.title, values=(node.child_count), tags=self.row_tags(node.index))
+        if not node.is_leaf:
+            ttk.Treeview.insert(self, node.name, "end", iid=node.name + PLACEHOLDER)
+
+    def populate(self, index):
+        if index in self.populated:
+            return
+        self.populated.add(index)
+        item = self.node.tree.ids[index]
+        self.delete(item + PLACEHOLDER)
+        for child in self.node.tree.node(index).children:
+            self.insert_node(item, child)
+
     def insert(self, parent, index, iid=None, **kwargs):
         if not "tags" in kwargs:
             kwargs["tags"] = ["unchecked"]
         elif not ("unchecked" in kwargs["tags"] or "checked" in kwargs["tags"] or "tristate" in kwargs["tags"]):
             kwargs["tags"] = ["unchecked"]
         ttk.Treeview.insert(self, parent, index, iid, **kwargs)
-        self.update_child_tags(parent)
-
-    def check_descendant(self, item):
-        children = self.get_children(item)
-        self.item(item, option='open')
-        if self.check_hidden.get() or self.item(item, option='open'):
-            for iid in children:
-                self.item(iid, tags=("checked",))
-                self.check_descendant(iid)
-
-    def check_ancestor(self, item):
-        self.item(item, tags=("checked",))
-        parent = self.parent(item)
-        if parent:
-            children = self.get_children(parent)
-            b = ["checked" in self.item(c, "tags") for c in children]
-            if False in b:
-                self.tristate_parent(parent)
-            else:
-                self.check_ancestor(parent)
 
-    def tristate_parent(self, item):
-        self.item(item, tags=("tristate",))
-        parent = self.parent(item)
-        if parent:
-            self.tristate_parent(parent)
-
-    def uncheck_descendant(self, item):
-        children = self.get_children(item)
-        print(self.item(item, option='open'))
-        if self.check_hidden.get() or self.item(item, option='open'):
-            for iid in children:
-                self.item(iid, tags=("unchecked",))
-                self.uncheck_descendant(iid)
-
-    def uncheck_ancestor(self, item):
-        self.item(item, tags=("unchecked",))
-        parent = self.parent(item)
-        if parent:
-            children = self.get_children(parent)
-            b = ["unchecked" in self.item(c, "tags") for c in children]
-            if False in b:
-                self.tristate_parent(parent)
+    def row_tags(self, index):
+        state = STATES[self.state[index]]
+        return (state,) if self.node.tree.is_leaf(index) else (state, "has_children")
+
+    def is_shown(self, index):
+        parents = self.node.tree.parents
+        parent = parents[index]
+        while parent >= 0:
+            if parent not in self.opened:
+                return False
+            parent = parents[parent]
+        return True
+
+    def redraw(self):
+        # only rows on screen are pushed to Tk, hidden ones wait until their parent is opened
+        # and rows that were never inserted get their state when they are
+        tree = self.node.tree
+        pending = set()
+        for index in self.state.changed:
+            parent = tree.parents[index]
+            if parent >= 0 and parent not in self.populated:
+                continue
+            if self.is_shown(index):
+                self.item(tree.ids[index], tags=self.row_tags(index))
             else:
-                self.uncheck_ancestor(parent)
+                pending.add(index)
+        self.state.changed = pending
 
     def box_click(self, event):
         x, y, widget = event.x, event.y, event.widget
@@ -174,13 +201,14 @@ class CheckboxTreeview(ttk.Treeview):
             self.select_item(item)
 
     def select_item(self, iid):
-        tags = self.item(iid, "tags")
-        if ("unchecked" in tags) or ("tristate" in tags):
-            self.check_ancestor(iid)
-            self.check_descendant(iid)
+        index = self.positions[iid]
+        check_hidden = self.check_hidden.get()
+        descend = lambda i: check_hidden or i in self.opened
+        if self.state[index] == CHECKED:
+            self.state.uncheck(index, descend)
         else:
-            self.uncheck_descendant(iid)
-            self.uncheck_ancestor(iid)
+            self.state.check(index, descend)
+        self.redraw()
 
     def is_descendant(self, item, ancestor):
         if item == ancestor:
@@ -205,19 +233,13 @@ class CheckboxTreeview(ttk.Treeview):
         self.after(10, lambda: self.bind("<<TreeviewSelect>>", self.on_select))
 
     def on_open(self, event):
-        selected_item = self.focus()
-        for child in self.get_children(selected_item):
-            current_tags = self.item(child, "tags")
-            if self.get_children(child):
-                new_tags = current_tags + ("has_children",)
-                self.item(child, tags=new_tags)
-
-    def update_child_tags(self, parent):
-        for child in self.get_children(parent):
-            current_tags = self.item(child, "tags")
-            if self.get_children(child):
-                new_tags = current_tags + ("has_children",)
-                self.item(child, tags=new_tags)
+        index = self.positions[self.focus()]
+        self.opened.add(index)
+        self.populate(index)
+        self.redraw()
+
+    def on_close(self, event):
+        self.opened.discard(self.positions[self.focus()])
 
     def is_visible(self, item):
         parent = self.parent(item)
@@ -230,7 +252,8 @@ class CheckboxTreeview(ttk.Treeview):
     def update_properties(self):
         if self.prop_node_id is None:
             return
-        return properties(self.node, self.prop_node_id.get())
+        index = self.positions.get(self.prop_node_id.get())
+        return self.node.tree.node(index) if index is not None else None
 
 class PropertyTreeview(ttk.Treeview):
     def __init__(self, master=None, **kwargs):
@@ -396,14 +419,16 @@ class ExportWindow(tk.Toplevel):
     def export(self):
         if self.export_selection.get() == "Selected":
             checked_root_node = self.tree.get_checked()
+            selected = self.tree.state.states
         else:
             checked_root_node = self.tree.node
-        paths, spreadsheet_name = extract_paths(checked_root_node, self.lo.get())
-        flattened_dict = level_flattening(paths, self.flatten.get())
-        spreadsheet_name = re.sub(r'[<>:"/\\|?*\x00-\x1F\s]+', '_', spreadsheet_name)
+            selected = None
+        paths, spreadsheet_name = extract_paths(checked_root_node, self.lo.get(), selected)
+        rows = level_flattening(paths, self.flatten.get())
+        spreadsheet_name = FILE_NAME_CHARS.sub("_", spreadsheet_name)
         spreadsheet_name = spreadsheet_name + f"_{int(time.time())}"
         file_path = os.path.join(self.folder_entry.get(), spreadsheet_name)
-        sofia_exporter(file_path, flattened_dict, self.sortby.get(), self.file_type)
+        sofia_exporter(file_path, rows, self.sortby.get(), FILE_TYPES if self.file_type == EXPORT_ALL else self.file_type)
 
     def pick_folder(self):
         folder_selected = filedialog.askdirectory(initialdir=self.folder_path.get())
@@ -414,6 +439,170 @@ class ExportWindow(tk.Toplevel):
             self.folder_entry.insert(0, folder_selected)
             self.folder_entry.configure(state = tk.DISABLED)
 
+class LoginWindow(tk.Toplevel):
+    def __init__(self, root):
+        tk.Toplevel.__init__(self, root)
+        self.btn_clicked = tk.IntVar()
+        self.session = get_session()
+        self.session.hold()
+        self.held = True
+        self.webscraper_thread = self.session.submit(self.session.ensure_started, last_profile() if PERSIST_SESSION else None)
+        self.webscraper_thread.add_done_callback(self.startup_callback)
+        self.title("Sign In")
+        self.geometry("400x350")
+        self.attributes('-topmost', True)
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+        self.root = root
+        self.username_var = tk.StringVar()
+        self.password_var = tk.StringVar()
+        self.logged_in = False
+        self.verifying = False
+        self.protocol("WM_DELETE_WINDOW", self.force_end)
+        self.transient(root)
+        self.grab_set()
+
+    @classmethod
+    def start_login(cls, root, callback, mainwindow_callback):
+        self = cls(root)
+
+        self.callback = callback
+        self.mainwindow_callback = mainwindow_callback
+        self.create_widgets()
+        self.await_login()
+
+    def create_widgets(self):
+        self.frame = ttk.Frame(self, padding="10 10 10 10")
+        self.frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), padx=10, pady=10)
+        self.frame.columnconfigure(0, weight=1)
+        self.frame.columnconfigure(1, weight=3)
+        self.frame.rowconfigure(2, weight=1)
+
+        label_username = tk.Label(self.frame, text="Shortcode:")
+        label_username.grid(column=0, row=0, padx=5, pady=5, sticky="NSW")
+        self.entry_username = tk.Entry(self.frame, textvariable=self.username_var)
+        self.entry_username.grid(column=1, row=0, padx=5, pady=5, sticky="NSWE")
+
+        label_pw = tk.Label(self.frame, text="Password:")
+        label_pw.grid(column=0, row=1, padx=5, pady=5, sticky="NSW")
+        self.entry_password = tk.Entry(self.frame, show="*", textvariable=self.password_var)
+        self.entry_password.grid(column=1, row=1, padx=5, pady=5, sticky="NSWE")
+
+        self.message = tk.Label(self.frame, text="", fg="#0c1069", font=("Helvetica", 12, "bold"), height=10)
+        self.message.grid(column=0, row=2, columnspan=2, sticky="NWE")
+
+        self.btn_login = tk.Button(self.frame, text="Login", command=lambda: self.btn_clicked.set(1))
+        self.btn_login.grid(column=0, row=3, columnspan=2)
+
+    def create_loading_widgets(self):
+        self.frame = ttk.Frame(self, padding="10 10 10 10")
+        self.frame.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), padx=10, pady=10)
+        self.frame.columnconfigure(0, weight=1)
+        self.frame.rowconfigure(1, weight=1)
+
+        self.loading_bar = ttk.Progressbar(self.frame, mode="indeterminate", orient="horizontal")
+        self.loading_bar.grid(column=0, row=0, padx=5, pady=5, sticky="SWE")
+        self.loading_bar.start(100)
+
+        self.message = tk.Label(self.frame, text="Loading...", fg="#0c1069", font=("Helvetica", 12, "bold"))
+        self.message.grid(column=0, row=1, sticky="NWE")
+        
+    def on_login(self):
+        if self.username_var.get() and self.password_var.get():
+            self.message.config(text="Processing", fg="#0c1069")
+            if self.webscraper_thread.done() and self.webscraper_thread.exception() is None:
+                if self.logged_in:
+                    self.after_login()
+                    return
+                self.webscraper_thread = self.session.submit(verify_credentials, self.web["driver"], self.show_number, self.username_var.get(), self.password_var.get())
+                self.webscraper_thread.add_done_callback(self.verification_callback)
+                return
+            print("Startup of scraper not done or called an exception")
+            return
+        self.message.config(text="Please fill in both fields.", foreground="#e62e09")
+        if not self.message.winfo_exists():
+            self.message.pack()
+
+    def show_number(self, number):
+        self.message.config(text=f"2FA number: {number}", fg="#4d6b0c")
+
+    def await_login(self):
+        self.btn_login.wait_variable(self.btn_clicked)
+        if self.logged_in: # saved session was still valid, no sign-in needed
+            print("Session restored: Scrapping has started")
+            self.after_login()
+            return
+        if self.verifying:
+            self.await_login()
+            return
+        self.on_login()
+        if self.logged_in:
+            print("Successful Sign-in: Scrapping has started")
+            self.after_login()
+            return
+        self.await_login()
+    
+    def after_login(self):
+        fetch = replay_traffic if REPLAY_MODE else monitor_traffic
+        self.webscraper_thread = self.session.submit(self.session.capture, fetch)
+        self.webscraper_thread.add_done_callback(self.scraping_callback)
+        self.frame.destroy()
+        self.create_loading_widgets()
+
+    def startup_callback(self, future):
+        print("Startup callback triggered")
+        self.web = future.result()
+        self.logged_in = bool(self.web["status"])
+        if self.logged_in:
+            self.btn_clicked.set(1)
+
+    def verification_callback(self, future):
+        result = future.result()
+        if result:
+            self.after_login()
+        else:
+            self.message.config(text="Verification failed", fg="#e62e09")
+
+    def scraping_callback(self, future):
+        if future.done():
+            if future.exception() is not None:
+                print(f"Scraping failed: {future.exception()}")
+            try:
+                self.end(future.exception() is None)
+            except Exception as exc:
+                print("Scraping had an exception")
+                print(exc)
+                print(future.exception())
+                self.callback()
+                self.mainwindow_callback()
+
+    def force_end(self):
+        # the scraper session stays up for the next fetch, its idle timeout or exit handler stops it
+        try:
+            self.destroy()
+            self.update()
+            self.callback()
+            self.mainwindow_callback()
+        except:
+            print("Force ended")
+
+    def destroy(self):
+        if self.held: # the idle timeout counts again once the window is gone
+            self.held = False
+            self.session.release()
+        tk.Toplevel.destroy(self)
+
+    def end(self, captured=True):
+        # only a session that got through the capture is worth reusing next time
+        shortcode = self.username_var.get() or self.web["shortcode"]
+        if PERSIST_SESSION and shortcode and captured:
+            self.session.submit(save_session, self.web["driver"], shortcode)
+        self.destroy()
+        self.update()
+        self.callback()
+        self.mainwindow_callback()
+        print("Login Window destroyed")
+
 class MainWindow:
     def __init__(self, root):
         self.root = root
@@ -490,7 +679,7 @@ class MainWindow:
         self.current_convert_type = tk.StringVar(value="xlsx")
         self.export_btn = ttk.Button(self.export_frame, text="Export", padding="5 5 5 5", name="export", command=self.open_export_window)
         self.export_btn.grid(row=0, column=0, columnspan=2, ipadx=5, ipady=5, padx=5, pady=5)
-        self.convert_type_box = ttk.Combobox(self.export_frame, justify="left", height="20", state="readonly", values=FILE_TYPES, textvariable=self.current_convert_type)
+        self.convert_type_box = ttk.Combobox(self.export_frame, justify="left", height="20", state="readonly", values=FILE_TYPES + [EXPORT_ALL], textvariable=self.current_convert_type)
         self.convert_type_box.grid(row=0, column=2, ipadx=5, ipady=5, padx=5, pady=5)
 
         self.current_response.trace_add("write", lambda *args: self.curriculum_box.update_list(self.current_response))